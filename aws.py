@@ -1,42 +1,21 @@
 ﻿import streamlit as st
-import requests
-import os
-import time
-import json
-import boto3
 from dotenv import load_dotenv
 
-# .env を読み込む
+# .env を読み込む（共有モジュールは読み込み時に設定を参照するので、import より先に読み込む）
 load_dotenv()
 
-# Bedrock クライアント設定
-bedrock = boto3.client(
-    service_name="bedrock-runtime",
-    region_name=os.getenv("AWS_REGION", "ap-northeast-1")
-)
+import llm
+from query_cache import get_query_cache
+from pubmed import search_pubmed, fetch_pubmed_metadata_batch
 
-# Claude 3 Sonnet モデル ID（2024年6月時点）
-# model_id = "anthropic.claude-sonnet-4-20250514-v1:0"
-# model_id = "anthropic.claude-3-7-sonnet-20250219-v1:0"
-model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
+# 使用するモデル（llm.MODELS のエントリ名）
+# model = "Claude Sonnet 4"
+# model = "Claude 3.7 Sonnet"
+model = "Claude 3 Sonnet (オンデマンド)"
 
 # Claude に問い合わせる関数
 def ask_claude(prompt, system_prompt):
-    response = bedrock.invoke_model(
-        modelId=model_id,
-        contentType="application/json",
-        accept="application/json",
-        body=json.dumps({
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": 0.5,
-            "max_tokens": 1024
-        })
-    )
-    result = json.loads(response['body'].read())
-    return result["content"][0]["text"].strip()
+    return llm.complete(model, prompt, system_prompt).text
 
 # PubMed検索用クエリ生成
 def ask_gpt_for_pubmed_query(user_input):
@@ -49,7 +28,15 @@ def ask_gpt_for_pubmed_query(user_input):
 2. クエリはPubMedの検索構文に従い、論理演算子（AND, OR）を使用してください。
 3. 基本形式: (疾患名 OR 同義語) AND (目的) AND (対象) AND ("2020"[PDat] : "3000"[PDat])
 """
-    return ask_claude(user_input, system_prompt)
+    # 似た質問に対して生成済みのクエリがあれば、それを使う
+    query_cache = get_query_cache()
+    cached = query_cache.get(user_input, model)
+    if cached is not None:
+        return cached
+    query = ask_claude(user_input, system_prompt)
+    if query.strip():
+        query_cache.put(user_input, query, model)
+    return query
 
 # Abstractを日本語で要約
 def summarize_in_japanese(abstract_text):
@@ -60,37 +47,6 @@ def summarize_in_japanese(abstract_text):
     except:
         return "要約に失敗しました。"
 
-# PubMed検索
-def search_pubmed(query, max_results=3):
-    url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-    params = {
-        "db": "pubmed",
-        "term": query,
-        "retmode": "json",
-        "retmax": max_results
-    }
-    res = requests.get(url, params=params).json()
-    return res.get('esearchresult', {}).get('idlist', [])
-
-# 論文情報とAbstract取得
-def fetch_pubmed_metadata(pmid):
-    summary_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi"
-    abstract_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
-
-    summary = requests.get(summary_url, params={"db": "pubmed", "id": pmid, "retmode": "json"}).json()
-    doc = summary["result"][pmid]
-
-    abstract_res = requests.get(abstract_url, params={"db": "pubmed", "id": pmid, "retmode": "text", "rettype": "abstract"})
-    abstract_text = abstract_res.text.strip()
-
-    return {
-        "title": doc.get("title", ""),
-        "authors": ", ".join([a["name"] for a in doc.get("authors", [])[:3]]),
-        "pubdate": doc.get("pubdate", ""),
-        "url": f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/",
-        "abstract": abstract_text
-    }
-
 # Streamlit アプリ
 st.set_page_config(page_title="医療文献検索AI", layout="wide")
 st.title("🧠 医療文献検索チャット (PubMed + Claude3)")
@@ -112,10 +68,10 @@ if user_input:
         if not pmids:
             st.error("❌ 該当する論文が見つかりませんでした。")
         else:
-            for pmid in pmids:
-                time.sleep(1)  # API負荷対策
-                data = fetch_pubmed_metadata(pmid)
+            with st.spinner("📄 論文情報を取得中..."):
+                papers = fetch_pubmed_metadata_batch(pmids)
 
+            for data in papers:
                 st.markdown("----")
                 st.subheader(f"📄 {data['title']}")
                 st.markdown(f"👨‍⚕️ **著者:** {data['authors']}　｜　📅 **発表日:** {data['pubdate']}")
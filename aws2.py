@@ -1,176 +1,119 @@
 ﻿import streamlit as st
-import requests
-import os
-import time
-import json
-import boto3
 from dotenv import load_dotenv
-import time
 
-# .env を読み込む
+# .env を読み込む（共有モジュールは読み込み時に設定を参照するので、import より先に読み込む）
 load_dotenv()
 
-# 推論プロファイルの ARN（Claude 3 用）
-# inference_profile_arn = os.getenv("BEDROCK_INFERENCE_PROFILE_ARN")
-
-# Bedrock クライアント設定
-bedrock = boto3.client(
-    service_name="bedrock-runtime",
-    region_name=os.getenv("AWS_REGION", "ap-northeast-1"),
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-)
-# session = boto3.Session(profile_name="Bedrock", region_name="ap-northeast-1")
-# bedrock = session.client("bedrock-runtime")
-
-
-def get_inference_profile_arn(selected_model):
-    arn = ''
-    if selected_model == 'Claude 3 Sonnet':
-        arn = inference_profile_arn = os.getenv("BEDROCK_INFERENCE_PROFILE_ARN_3")
-    if selected_model == 'Claude 3.7 Sonnet':
-        arn = inference_profile_arn = os.getenv("BEDROCK_INFERENCE_PROFILE_ARN_37")
-    if selected_model == 'Claude Sonnet 4':
-        arn = inference_profile_arn = os.getenv("BEDROCK_INFERENCE_PROFILE_ARN_4")
-    return arn
-
-# Claude に問い合わせる共通関数
-# def ask_claude_3(prompt, system_prompt, selected_model):
-#     response = bedrock.invoke_model(
-#         modelId=get_inference_profile_arn(selected_model),  # ← ここが推論プロファイル ARN
-#         contentType="application/json",
-#         accept="application/json",
-#         body=json.dumps({
-#             "messages": [
-#                 {"role": "system", "content": system_prompt},
-#                 {"role": "user", "content": prompt}
-#             ],
-#             "temperature": 0,
-#             "max_tokens": 16384
-#         })
-#     )
-#     result = json.loads(response['body'].read())
-#     return result["content"][0]["text"].strip()
-
-def ask_claude_3(prompt, system_prompt, selected_model):
-    response = bedrock.invoke_model(
-        modelId=get_inference_profile_arn(selected_model),
-        contentType="application/json",
-        accept="application/json",
-        body=json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",  # ✅ Claude用必須
-            "messages": [
-                {"role": "user", "content": f"{system_prompt}\n\n{prompt}"}
-            ],
-            "max_tokens": 1024,
-            "temperature": 0
-        })
-    )
-    result = json.loads(response['body'].read())
-    return result["content"][0]["text"].strip()
-
-# Claude 3.7/4 Sonnet を呼び出す関数
-def ask_claude_4(prompt, system_prompt, selected_model):
-    response = bedrock.invoke_model(
-        modelId=get_inference_profile_arn(selected_model),  # ← ここが推論プロファイル ARN
-        contentType="application/json",
-        accept="application/json",
-        body=json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",  # Claude 3 では必須
-            "system": system_prompt,  # ここに system プロンプト
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "temperature": 0,
-            "max_tokens": 16384  # Claude 3 の通常出力は 1,024 ～ 4,096 程度が適切
-        })
-    )
-    result = json.loads(response['body'].read())
-    # Claude 3 の出力構造は content: [{ "text": "..." }]
-    return result["content"][0]["text"].strip()
-
-# Claude 3.7 Sonnet を呼び出す関数
-def ask_claude_37(prompt, system_prompt):
-    response = bedrock.invoke_model(
-        modelId=inference_profile_arn,
-        contentType="application/json",
-        accept="application/json",
-        body=json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",  # Claude 3.x 必須
-            "system": system_prompt,
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": 0,
-            "max_tokens": 16384  # 通常は 1024〜4096 程度が適切
-        })
-    )
-    result = json.loads(response["body"].read())
-    return result["content"][0]["text"].strip()
-
-# PubMed検索クエリ生成
-def ask_gpt_for_pubmed_query(user_input):
-    system_prompt = """
-あなたはPubMedの検索クエリを作成する専門家です。
-日本語の医学的な質問に対して、PubMedで検索するための英語の検索クエリを作成してください。
-検索クエリが作成できない場合は、空文字を返してください。
-
-【ルール】
-1. 回答は検索キーワード（検索式）のみで返してください。説明は不要です。
-2. クエリはPubMedの検索構文に従い、論理演算子（AND, OR）を使用してください。
-3. 基本形式: (疾患名 OR 同義語) AND (目的) AND (対象) AND ("2020"[PDat] : "3000"[PDat])
-"""
-    if model == 'Claude 3 Sonnet':
-        return ask_claude_3(user_input, system_prompt, model)
-    else:
-        return ask_claude_4(user_input, system_prompt, model)
-        
-
-# Abstractを日本語で要約
-def summarize_in_japanese(abstract_text):
-    system_prompt = "PubMedから取得したAbstractです。日本語で、情報量を落とさずに箇条書きで、要約してください。箇条書きは、読みやすくするためひとつずつ改行してください。"
-    prompt = f"--- Abstract ---\n{abstract_text}"
-    try:
-        if model == 'Claude 3 Sonnet':
-            return ask_claude_3(prompt, system_prompt, model)
-        else:
-            return ask_claude_4(prompt, system_prompt, model)
-    except:
-        return "要約に失敗しました。"
-
-# PubMed検索
-def search_pubmed(query, max_results=3):
-    url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-    params = {
-        "db": "pubmed",
-        "term": query,
-        "retmode": "json",
-        "retmax": max_results
-    }
-    res = requests.get(url, params=params).json()
-    return res.get('esearchresult', {}).get('idlist', [])
-
-# PubMedの論文情報とAbstractを取得
-def fetch_pubmed_metadata(pmid):
-    summary_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi"
-    abstract_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
-
-    summary = requests.get(summary_url, params={"db": "pubmed", "id": pmid, "retmode": "json"}).json()
-    doc = summary["result"][pmid]
-
-    abstract_res = requests.get(abstract_url, params={"db": "pubmed", "id": pmid, "retmode": "text", "rettype": "abstract"})
-    abstract_text = abstract_res.text.strip()
-
-    return {
-        "title": doc.get("title", ""),
-        "authors": ", ".join([a["name"] for a in doc.get("authors", [])[:3]]),
-        "pubdate": doc.get("pubdate", ""),
-        "url": f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/",
-        "abstract": abstract_text
-    }
+import os
+from concurrent.futures import ThreadPoolExecutor
+import llm
+import metrics
+import pipeline
+import pubmed
+import router
+import jobs
+from session_store import compact_blocks, expand_blocks
+
+# 要約リクエストの同時実行数（Bedrock のクォータを超えないように調整）
+SUMMARY_MAX_WORKERS = int(os.getenv("SUMMARY_MAX_WORKERS", "3"))
+
+# 要約用のワーカープール（再実行やセッションをまたいで1つだけ作る）
+@st.cache_resource
+def get_summary_executor(max_workers):
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary")
+
+
+# esearch をローカル検索と並行して実行するためのワーカープール
+SEARCH_MAX_WORKERS = int(os.getenv("SEARCH_MAX_WORKERS", "4"))
+
+@st.cache_resource
+def get_search_executor(max_workers):
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search")
+
+
+# 1ページに表示する論文の数（「さらに論文を表示」で同じ数ずつ取得する）
+PAPERS_PER_PAGE = int(os.getenv("PAPERS_PER_PAGE", "3"))
+
+# 実行中のジョブの途中経過を読み出す間隔（秒）
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+
+# 履歴に一度に表示する会話の数（「さらに表示」で同じ数ずつ増やす）
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "5"))
+
+# サイドバーで選択できるモデル（llm.MODELS の設定から）
+MODEL_NAMES = llm.selectable_models()
+
+# プロンプトを変更した後、古いバージョンの要約をプロセス起動時に1回だけ削除する
+@st.cache_resource
+def purge_old_summaries():
+    pipeline.purge_old_summaries(MODEL_NAMES)
+
+# 論文情報の形式を変更した後、古い形式のキャッシュをプロセス起動時に1回だけ削除する
+@st.cache_resource
+def purge_old_records():
+    pubmed.purge_old_records()
+
+# メトリクスの出力（METRICS_PORT / METRICS_FILE）をプロセス起動時に1回だけ開始する
+@st.cache_resource
+def start_metrics_exporters():
+    metrics.start_exporters()
+
+# サイドバーの診断パネル（段階ごとの処理時間・トークン数・キャッシュヒット率・リトライ回数）
+def render_diagnostics():
+    snapshot = metrics.get_metrics().snapshot()
+    with st.sidebar.expander("📊 診断情報", expanded=True):
+        if not snapshot["stages"]:
+            st.caption("まだ計測値がありません。")
+            return
+        st.markdown("**処理時間（秒）**")
+        st.dataframe([
+            {"段階": s["stage"], "件数": s["count"], "p50": round(s["p50"], 2), "p95": round(s["p95"], 2),
+             "目標": s["slo"], "超過": s["violations"]}
+            for s in snapshot["stages"]
+        ], hide_index=True)
+        if snapshot["llm"]:
+            st.markdown("**LLM**")
+            st.dataframe([
+                {"モデル": m["model"], "呼び出し": m["requests"], "入力トークン": m["input_tokens"],
+                 "出力トークン": m["output_tokens"], "リトライ": m["retries"]}
+                for m in snapshot["llm"]
+            ], hide_index=True)
+        routes = router.get_router().snapshot()
+        if routes:
+            st.markdown("**モデルの応答時間（自動選択）**")
+            st.dataframe([
+                {"タスク": r["task"], "モデル": r["model"], "件数": r["count"], "p50": round(r["p50"], 2),
+                 "出力 p99": round(r["output_p99"]) if r["output_p99"] is not None else None}
+                for r in routes
+            ], hide_index=True)
+        limiters = llm.limiter_snapshot()
+        if limiters:
+            st.markdown("**Bedrock の同時実行数**")
+            st.dataframe([
+                {"モデル": l["model"], "上限": l["limit"], "実行中": l["in_flight"],
+                 "状態": "混雑中" if l["throttled"] else "正常"}
+                for l in limiters
+            ], hide_index=True)
+        if snapshot["caches"]:
+            st.markdown("**キャッシュ**")
+            st.dataframe([
+                {"キャッシュ": c["cache"], "ヒット": c["hits"], "ミス": c["misses"], "ヒット率": f"{c['hit_rate']:.0%}"}
+                for c in snapshot["caches"]
+            ], hide_index=True)
+        if snapshot["http"]:
+            st.markdown("**HTTP**")
+            st.dataframe([
+                {"エンドポイント": h["endpoint"], "リクエスト": h["requests"], "リトライ": h["retries"]}
+                for h in snapshot["http"]
+            ], hide_index=True)
+
+# PubMed の検索結果が届くまで、ローカルの検索インデックスでヒットした論文を候補として表示する
+def render_local_hits(hits):
+    st.caption("⚡ 過去に取得した論文からの候補（PubMed の検索結果を取得中）")
+    for data in hits:
+        st.markdown(f"**📄 {data['title']}**　｜　📅 {data['pubdate']}　｜　🔗 [PubMed]({data['url']})")
+        if data["summary"]:
+            st.success(f"📝 要約: {data['summary']}")
 
 # Streamlit UI
 # st.set_page_config(page_title="医療文献検索AI", layout="wide")
@@ -210,14 +153,112 @@ def fetch_pubmed_metadata(pmid):
 #                     st.warning("⚠️ この論文にはAbstractが含まれていません。")
 
 
+# 応答ブロックを表示する
+def render_blocks(blocks):
+    for block in expand_blocks(blocks):
+        if block["type"] == "query":
+            st.markdown(f"**🔍 検索クエリ**: `{block['query']}`")
+            others = [q for q in block.get("candidates", []) if q != block["query"]]
+            if others:
+                st.caption("その他の検索式の候補: " + " ／ ".join(f"`{q}`" for q in others))
+        elif block["type"] == "paper":
+            st.markdown("----")
+            st.subheader(f"📄 {block['title']}")
+            st.markdown(f"👨‍⚕️ **著者:** {block['authors']}　｜　📅 **発表日:** {block['pubdate']}")
+            st.markdown(f"🔗 [PubMedリンクはこちら]({block['url']})")
+            if block.get("pending"):
+                st.info(f"📝 要約: {block['summary']}▌" if block["summary"] else "📝 要約生成中...")
+            elif block["summary"]:
+                st.success(f"📝 要約: {block['summary']}")
+            else:
+                st.warning("⚠️ この論文にはAbstractが含まれていません。")
+        elif block["type"] == "error":
+            st.error(block["message"])
+
+# 会話を「ユーザーの質問＋アシスタントの応答」の単位にまとめる
+def group_turns(messages):
+    turns = []
+    for msg in messages:
+        if msg["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(msg)
+    return turns
+
+def show_more_history():
+    st.session_state.history_pages += 1
+
+def load_more_papers():
+    st.session_state.load_more = True
+
+# 完了したジョブを登録順に受け取り、会話履歴に移す（先頭のジョブが実行中ならそこで止める）
+def collect_jobs():
+    job_queue = jobs.get_job_queue()
+    while st.session_state.jobs:
+        entry = st.session_state.jobs[0]
+        job = job_queue.get(entry["id"])
+        if job is not None and not job.finished:
+            break
+        st.session_state.jobs.pop(0)
+        if job is None:
+            # 保持期間を過ぎた、またはプロセスが再起動した
+            blocks = [{"type": "error", "message": "❌ 処理結果を取得できませんでした。もう一度お試しください。"}]
+            result = None
+        else:
+            job_queue.collect(entry["id"])
+            snapshot = job.snapshot()
+            blocks, result = snapshot["blocks"], snapshot["result"]
+            if snapshot["status"] == "error":
+                blocks.append({"type": "error", "message": f"❌ 処理中にエラーが発生しました: {snapshot['error']}"})
+        if entry["question"] is not None:
+            st.session_state.messages.append({"role": "user", "content": entry["question"]})
+        # アシスタント応答を構造化して保存（論文の本文は共有ストアに移して参照だけを持つ）
+        st.session_state.messages.append({"role": "assistant", "content": compact_blocks(blocks)})
+        if entry["kind"] == "answer" or result is not None:
+            st.session_state.search = result
+
+# 実行中のジョブの途中経過を表示する（JOB_POLL_INTERVAL 秒ごとにこの部分だけを再実行する）
+# 先頭のジョブが完了したら画面全体を再実行して会話履歴に移す
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_running_jobs():
+    job_queue = jobs.get_job_queue()
+    for i, entry in enumerate(st.session_state.jobs):
+        job = job_queue.get(entry["id"])
+        if i == 0 and (job is None or job.finished):
+            st.rerun()
+        if entry["question"] is not None:
+            with st.chat_message("user"):
+                st.markdown(entry["question"])
+        with st.chat_message("assistant"):
+            if job is None:
+                continue
+            snapshot = job.snapshot()
+            render_blocks(snapshot["blocks"])
+            if snapshot["preview"]:
+                render_local_hits(snapshot["preview"])
+            if snapshot["status"] == "queued":
+                st.info("⏳ 順番待ちです...")
+            elif snapshot["progress"]:
+                st.info(f"⏳ {snapshot['progress']}")
+
+
 # ----------------------------------------------
 # サイドバーのタイトルを表示
 st.sidebar.title("Options")
 
 # サイドバーにオプションボタンを設置
-model = st.sidebar.radio("生成AIを選択(バージョンが上がるほど、高機能)", (
-    "Claude 3 Sonnet", "Claude 3.7 Sonnet", "Claude Sonnet 4"
-), index=2)
+# 「自動」はクエリ生成・要約ごとに、応答の速いモデルを選ぶ
+model_options = [router.AUTO_MODEL] + MODEL_NAMES
+model = st.sidebar.radio("生成AIを選択(バージョンが上がるほど、高機能)", model_options,
+                         index=model_options.index(llm.DEFAULT_MODEL))
+
+# 要約を生成しながら少しずつ表示する
+stream_mode = st.sidebar.checkbox("要約をストリーミング表示", value=True)
+
+# すべてのAbstractを1回の呼び出しでまとめて要約する（失敗した論文だけ1件ずつ要約し直す）
+batch_mode = st.sidebar.checkbox("一括要約モード", value=False)
+
+# 処理時間などの計測値をサイドバーに表示する（画面の最後に描画する）
+show_diagnostics = st.sidebar.checkbox("診断情報を表示", value=False)
 
 # サイドバーにボタンを設置
 # clear_button = st.sidebar.button("Clear Conversation", key="clear")
@@ -234,130 +275,73 @@ model = st.sidebar.radio("生成AIを選択(バージョンが上がるほど、
 #     st.sidebar.markdown(f"- ${i+0.01}")  # 説明のためのダミー
 # ----------------------------------------------
 
+purge_old_summaries()
+purge_old_records()
+start_metrics_exporters()
+
 # セッション初期化（構造化されたメッセージ）
+# 論文ブロックは参照（session_store）だけを持ち、本文はプロセス共有のストアに置く
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "history_pages" not in st.session_state:
+    st.session_state.history_pages = 1
+# 直近の検索の履歴サーバー上の位置（WebEnv / query_key）と、次に取得する位置（retstart）
+if "search" not in st.session_state:
+    st.session_state.search = None
+# 実行中・受け取り待ちのジョブ（登録順。{"id", "kind", "question"}）
+if "jobs" not in st.session_state:
+    st.session_state.jobs = []
 
 st.set_page_config(page_title="医療文献検索AI", layout="wide")
 st.title("🧠 医療文献検索チャット (PubMed + Claude)")
 
-# ✅ チャット履歴の再描画（構造ごとに表示）
-for msg in st.session_state.messages:
-    with st.chat_message(msg["role"]):
-        if msg["role"] == "user":
-            st.markdown(msg["content"])
-        else:
-            for block in msg["content"]:
-                if block["type"] == "query":
-                    st.markdown(f"**🔍 検索クエリ**: `{block['query']}`")
-                elif block["type"] == "paper":
-                    st.markdown("----")
-                    st.subheader(f"📄 {block['title']}")
-                    st.markdown(f"👨‍⚕️ **著者:** {block['authors']}　｜　📅 **発表日:** {block['pubdate']}")
-                    st.markdown(f"🔗 [PubMedリンクはこちら]({block['url']})")
-                    if block["summary"]:
-                        st.success(f"📝 要約: {block['summary']}")
-                    else:
-                        st.warning("⚠️ この論文にはAbstractが含まれていません。")
-                elif block["type"] == "error":
-                    st.error(block["message"])
+collect_jobs()
+
+# ✅ チャット履歴の再描画（直近の会話だけを表示し、古い応答は折りたたむ）
+turns = group_turns(st.session_state.messages)
+visible_turns = turns[-HISTORY_PAGE_SIZE * st.session_state.history_pages:]
+hidden_count = len(turns) - len(visible_turns)
+if hidden_count > 0:
+    st.button(f"さらに過去の会話を表示（残り {hidden_count} 件）", on_click=show_more_history)
+
+for i, turn in enumerate(visible_turns):
+    latest = i == len(visible_turns) - 1
+    for msg in turn:
+        with st.chat_message(msg["role"]):
+            if msg["role"] == "user":
+                st.markdown(msg["content"])
+            elif latest:
+                render_blocks(msg["content"])
+            else:
+                with st.expander("📄 回答を表示", expanded=False):
+                    render_blocks(msg["content"])
 
 # ユーザー入力欄
 user_input = st.chat_input("調べたい医学的な質問を入力してください")
+load_more = st.session_state.pop("load_more", False)
 
+# 処理はバックグラウンドのジョブで行い、セッションにはジョブ ID だけを持つ
+# （画面の操作で再実行されても処理は止まらず、完了した結果は次の再実行で会話履歴に移す）
 if user_input:
-    # ユーザー入力を保存・表示
-    with st.chat_message("user"):
-        st.markdown(user_input)
-    st.session_state.messages.append({"role": "user", "content": user_input})
-
-    # アシスタント応答処理
-    with st.chat_message("assistant"):
-        response_blocks = []
-
-        # with st.spinner("🔍 PubMed検索クエリを生成中..."):
-        #     query = ask_gpt_for_pubmed_query(user_input)
-        #     st.markdown(f"**🔍 検索クエリ**: `{query}`")
-        #     response_blocks.append({"type": "query", "query": query})
-
-
-        # with st.spinner("🔍 PubMed検索クエリを生成中..."):
-        #     query = ask_gpt_for_pubmed_query(user_input).strip()
-
-        #     if query == "":
-        #         warning_msg = "⚠️ 適切な医学的な質問を入力してください。"
-        #         st.warning(warning_msg)
-
-        #         # 表示＋履歴に追加（構造化）
-        #         response_blocks.append({"type": "error", "message": warning_msg})
-        #         st.session_state.messages.append({
-        #             "role": "assistant",
-        #             "content": response_blocks
-        #         })
-        #         # この後の処理はスキップ
-        #         st.stop()
-
-        with st.spinner("🔍 PubMed検索クエリを生成中..."):
-            try:
-                query = ask_gpt_for_pubmed_query(user_input).strip()
-            except Exception as e:
-                error_msg = f"❌ クエリ生成中にエラーが発生しました: {str(e)}"
-                st.error(error_msg)
-                response_blocks.append({"type": "error", "message": error_msg})
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response_blocks
-                })
-                st.stop()
-
-            print(f"[DEBUG] raw query: '{query}'") 
-
-            if not query or query == '""':
-                warning_msg = "⚠️ 適切な医学的な質問を入力してください。"
-                st.warning(warning_msg)
-                response_blocks.append({"type": "error", "message": warning_msg})
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response_blocks
-                })
-                st.stop()
-
-        st.markdown(f"**🔍 検索クエリ**: `{query}`")
-        response_blocks.append({"type": "query", "query": query})           
-            
-        with st.spinner("📚 論文を検索中..."):
-            pmids = search_pubmed(query)
-
-        if not pmids:
-            error_msg = "❌ 該当する論文が見つかりませんでした。"
-            st.error(error_msg)
-            response_blocks.append({"type": "error", "message": error_msg})
-        else:
-            for pmid in pmids:
-                time.sleep(1)
-                data = fetch_pubmed_metadata(pmid)
-
-                st.markdown("----")
-                st.subheader(f"📄 {data['title']}")
-                st.markdown(f"👨‍⚕️ **著者:** {data['authors']}　｜　📅 **発表日:** {data['pubdate']}")
-                st.markdown(f"🔗 [PubMedリンクはこちら]({data['url']})")
-
-                summary_text = ""
-                if data['abstract']:
-                    with st.spinner("📝 要約生成中..."):
-                        summary_text = summarize_in_japanese(data['abstract'])
-                    st.success(f"📝 要約: {summary_text}")
-                else:
-                    st.warning("⚠️ この論文にはAbstractが含まれていません。")
-
-                response_blocks.append({
-                    "type": "paper",
-                    "title": data["title"],
-                    "authors": data["authors"],
-                    "pubdate": data["pubdate"],
-                    "url": data["url"],
-                    "summary": summary_text
-                })
-
-        # アシスタント応答を構造化して保存
-        st.session_state.messages.append({"role": "assistant", "content": response_blocks})
\ No newline at end of file
+    st.session_state.search = None
+    job_id = jobs.get_job_queue().submit(
+        "answer", pipeline.answer_job, user_input, model, batch_mode, stream_mode,
+        get_summary_executor(SUMMARY_MAX_WORKERS), get_search_executor(SEARCH_MAX_WORKERS), PAPERS_PER_PAGE)
+    st.session_state.jobs.append({"id": job_id, "kind": "answer", "question": user_input})
+
+elif load_more and st.session_state.search and not st.session_state.jobs:
+    job_id = jobs.get_job_queue().submit(
+        "more", pipeline.more_papers_job, st.session_state.search, batch_mode, stream_mode,
+        get_summary_executor(SUMMARY_MAX_WORKERS), PAPERS_PER_PAGE)
+    st.session_state.jobs.append({"id": job_id, "kind": "more", "question": None})
+
+if st.session_state.jobs:
+    show_running_jobs()
+
+search = st.session_state.search
+if search and not st.session_state.jobs and (search["ranked"] or search["retstart"] < search["count"]):
+    st.button(f"さらに論文を表示（全 {search['count']} 件中 {search['shown']} 件表示済み）",
+              on_click=load_more_papers)
+
+if show_diagnostics:
+    render_diagnostics()
\ No newline at end of file
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+
+# .env を読み込む（共有モジュールは読み込み時に設定を参照するので、import より先に読み込む）
+load_dotenv()
+
+import llm
+import metrics
+import router
+from pipeline import answer_question
+
+# 質問の JSONL ファイルをまとめて処理するバッチ（Streamlit を使わずに実行できる）
+#
+#   python batch.py questions.jsonl -o answers.jsonl --workers 4
+#
+# - 入力は1行1件の JSON（既定では {"id": ..., "question": ...}）。ファイル全体を読み込まずに1行ずつ処理する
+# - 結果は1件終わるごとに出力ファイルへ追記する
+# - 途中で止まっても、同じコマンドを再実行すれば成功済みの id を飛ばして続きから処理する
+# - METRICS_FILE を指定すると、処理中は定期的に、終了時にも計測値を書き出す
+
+
+# 出力ファイルから成功済みの id を集める（途中で書きかけになった行は無視する）
+def load_done_ids(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not record.get("error_type"):
+                done.add(str(record.get("id")))
+    return done
+
+
+# 入力ファイルから (id, 質問) を1件ずつ取り出す。id が無い行は行番号を id にする
+def iter_questions(path, id_field, question_field):
+    with open(path, encoding="utf-8-sig") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print(f"[WARN] {path}:{lineno} を JSON として読めないため飛ばします", file=sys.stderr)
+                continue
+            question = record.get(question_field)
+            if not question:
+                print(f"[WARN] {path}:{lineno} に '{question_field}' が無いため飛ばします", file=sys.stderr)
+                continue
+            yield str(record.get(id_field, lineno)), question
+
+
+# 結果を1行ずつ追記するライター（複数スレッドから呼ばれる）
+class ResultWriter:
+    def __init__(self, path):
+        # 前回の書き込みが行の途中で止まっていた場合は改行してから追記する
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        else:
+            needs_newline = False
+        self._file = open(path, "a", encoding="utf-8")
+        if needs_newline:
+            self._file.write("\n")
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def process(question_id, question, args):
+    started = time.monotonic()
+    try:
+        record = answer_question(question, args.model, max_results=args.max_results,
+                                 batch_summary=args.batch_summary)
+    except Exception as e:
+        record = {"question": question, "model": args.model, "error": str(e), "error_type": type(e).__name__}
+    record["id"] = question_id
+    record["elapsed"] = round(time.monotonic() - started, 3)
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="質問の JSONL ファイルを PubMed 検索 + 要約でまとめて処理します")
+    parser.add_argument("input", help="質問の JSONL ファイル")
+    parser.add_argument("-o", "--output", required=True, help="結果を追記する JSONL ファイル")
+    parser.add_argument("--model", default=llm.DEFAULT_MODEL, choices=list(llm.MODELS) + [router.AUTO_MODEL],
+                        help="使用するモデル（「自動」ならタスクごとに選ぶ）")
+    parser.add_argument("--workers", type=int, default=4, help="同時に処理する質問の数")
+    parser.add_argument("--max-results", type=int, default=3, help="1つの質問で要約する論文の数")
+    parser.add_argument("--batch-summary", action="store_true", help="Abstract を1回の呼び出しでまとめて要約する")
+    parser.add_argument("--id-field", default="id", help="入力の id のフィールド名")
+    parser.add_argument("--question-field", default="question", help="入力の質問文のフィールド名")
+    args = parser.parse_args(argv)
+
+    done = load_done_ids(args.output)
+    if done:
+        print(f"[INFO] 処理済みの {len(done)} 件を飛ばします", file=sys.stderr)
+
+    metrics.start_exporters()
+    writer = ResultWriter(args.output)
+    processed = failed = 0
+    # 投入済みで終わっていない件数を workers の2倍までに抑え、入力を少しずつ読む
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        in_flight = set()
+
+        def collect(futures):
+            nonlocal processed, failed
+            for future in futures:
+                record = future.result()
+                writer.write(record)
+                processed += 1
+                if record.get("error_type"):
+                    failed += 1
+                    print(f"[ERROR] id={record['id']}: {record['error']}", file=sys.stderr)
+                if processed % 10 == 0:
+                    print(f"[INFO] {processed} 件処理しました（失敗 {failed} 件）", file=sys.stderr)
+
+        try:
+            for question_id, question in iter_questions(args.input, args.id_field, args.question_field):
+                if question_id in done:
+                    continue
+                done.add(question_id)
+                in_flight.add(executor.submit(process, question_id, question, args))
+                if len(in_flight) >= args.workers * 2:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(finished)
+            finished, _ = wait(in_flight)
+            collect(finished)
+        finally:
+            writer.close()
+            metrics.write_file()
+
+    print(f"[INFO] 完了: {processed} 件処理しました（失敗 {failed} 件）", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
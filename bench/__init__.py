@@ -0,0 +1,2 @@
+# ローカルのスタブ（NCBI / Bedrock / Azure OpenAI の代わり）を使ったベンチマーク・負荷試験
+# 使い方は bench/__main__.py を参照
@@ -0,0 +1,232 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from bench.stubs import Faults, StubServer, FakeBedrockClient
+
+# ローカルのスタブを相手にパイプライン（クエリ生成 → 検索 → 論文取得 → 要約）の負荷試験を行う
+# 外部サービスには接続しないので、API キーや AWS の認証情報は不要（依存パッケージは必要）
+#
+#   python -m bench --sessions 8 --questions 5
+#   python -m bench --save-baseline bench_baseline.json
+#   python -m bench --baseline bench_baseline.json --tolerance 0.2
+#
+# - 同時に N セッションがそれぞれ M 件の質問を順に送る（aws2.py を N 人が同時に使う想定）
+# - 質問は aws2.py と同じく pipeline.answer_job をジョブキューで実行する（要約は共有のスレッドプールで並列に行う）
+# - 段階ごと（クエリ生成・ローカル検索・検索（候補の取得と並べ替え）・要約）と全体の p50 / p95 / p99 を表示する
+#   （処理時間はアプリの計測値（metrics.py の stage_seconds など）から求める）
+# - --baseline を渡すと保存済みの結果と比べ、p95 が許容幅を超えて悪化していれば終了コード 1 を返す
+
+# 表示する段階と、その処理時間を記録しているメトリクス（名前とラベル）
+STAGES = {
+    "query": ("stage_seconds", {"stage": "query"}),
+    "local": ("stage_seconds", {"stage": "local_search"}),
+    "search": ("stage_seconds", {"stage": "search"}),
+    "batch_summary": ("stage_seconds", {"stage": "batch_summary"}),
+    "summary": ("stage_seconds", {"stage": "summary"}),
+    "first_token": ("llm_first_token_seconds", {}),
+    "total": ("stage_seconds", {"stage": "total"}),
+}
+
+# 質問のひな形（--repeat-questions を付けない場合は番号を付けてすべて別の質問にする）
+QUESTION_TOPICS = (
+    "高血圧の治療に ARB と ACE 阻害薬のどちらが有効か",
+    "2型糖尿病で SGLT2 阻害薬は心不全を減らすか",
+    "心房細動の抗凝固療法で DOAC はワルファリンより安全か",
+    "COPD の増悪予防に吸入ステロイドは有効か",
+    "高齢者の骨粗鬆症でビスホスホネートは骨折を減らすか",
+)
+
+
+# 段階ごとの処理時間の集計（アプリの計測値から）
+def stage_summary():
+    import metrics
+
+    summary = {}
+    for stage, (name, labels) in STAGES.items():
+        values = metrics.get_metrics().samples(name, **labels)
+        summary[stage] = {
+            "count": len(values),
+            "p50": metrics.percentile(values, 50),
+            "p95": metrics.percentile(values, 95),
+            "p99": metrics.percentile(values, 99),
+            "max": max(values) if values else None,
+        }
+    return summary
+
+
+# ジョブの結果から失敗を数える（ジョブの例外・エラーの応答ブロック・要約の失敗）
+class ErrorCounter:
+    def __init__(self):
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+
+# aws2.py と同じく、1つの質問をジョブとして実行して完了を待つ
+def run_question(question, args, job_queue, executors, errors):
+    import pipeline
+
+    job_id = job_queue.submit("answer", pipeline.answer_job, question, args.model, args.batch_summary, args.stream,
+                              *executors, args.max_results)
+    job = job_queue.wait(job_id)
+    if job.status == "error":
+        errors.add(f"job: {job.error}")
+        return False
+    for block in job.blocks:
+        if block["type"] == "error":
+            errors.add(f"answer: {block['message']}")
+        elif block["type"] == "paper" and block["summary"] == pipeline.SUMMARY_FAILED:
+            errors.add(f"summary: {block['summary']}")
+    return job.result is not None
+
+
+def run_session(session, args, job_queue, executors, errors):
+    ok = 0
+    for i in range(args.questions):
+        topic = QUESTION_TOPICS[(session + i) % len(QUESTION_TOPICS)]
+        question = topic if args.repeat_questions else f"{topic}（{session}-{i}）"
+        ok += run_question(question, args, job_queue, executors, errors)
+    return ok
+
+
+def print_report(report, out=sys.stdout):
+    print(f"{'stage':<14}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}", file=out)
+    for stage in STAGES:
+        s = report["stages"][stage]
+        if not s["count"]:
+            continue
+        print(f"{stage:<14}{s['count']:>7}" + "".join(f"{s[k]:>10.3f}" for k in ("p50", "p95", "p99", "max")), file=out)
+    print(f"質問 {report['questions']} 件（成功 {report['succeeded']} 件） / {report['elapsed']:.2f} 秒 / "
+          f"{report['throughput']:.2f} 件/秒", file=out)
+    for key, count in sorted(report["errors"].items()):
+        print(f"  エラー {key}: {count} 件", file=out)
+    print(f"スタブへのリクエスト: {report['requests']}", file=out)
+
+
+# 保存済みの結果と比べ、p95 が (1 + tolerance) 倍を超えた段階を返す
+# 非常に短い段階の揺れで失敗しないよう、min_delta 秒未満の差は無視する
+def compare(report, baseline, tolerance, min_delta):
+    regressions = []
+    for stage in STAGES:
+        now = report["stages"].get(stage, {}).get("p95")
+        before = baseline["stages"].get(stage, {}).get("p95")
+        if now is None or before is None:
+            continue
+        if now > before * (1 + tolerance) and now - before > min_delta:
+            regressions.append((stage, before, now))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="ローカルのスタブを使ってパイプラインの負荷試験を行います")
+    parser.add_argument("--sessions", type=int, default=4, help="同時に動かすセッションの数")
+    parser.add_argument("--questions", type=int, default=5, help="1セッションあたりの質問の数")
+    parser.add_argument("--repeat-questions", action="store_true", help="同じ質問を繰り返す（キャッシュが効く場合の計測）")
+    parser.add_argument("--model", default="Claude Sonnet 4", help="使用するモデル（Bedrock または Azure OpenAI のスタブに送る）")
+    parser.add_argument("--max-results", type=int, default=3, help="1つの質問で要約する論文の数")
+    parser.add_argument("--stream", action="store_true", help="ストリーミングで要約する（最初のトークンまでの時間も計測する）")
+    parser.add_argument("--batch-summary", action="store_true", help="一括要約モードを使う")
+    parser.add_argument("--summary-workers", type=int, default=int(os.getenv("SUMMARY_MAX_WORKERS", "8")),
+                        help="要約スレッドプールの大きさ")
+    parser.add_argument("--ncbi-rate", type=float, default=0, help="NCBI のレート制限（回/秒、0 ならスタブ向けに制限しない）")
+    parser.add_argument("--ncbi-latency", type=float, default=0.05, help="NCBI スタブの応答遅延（秒）")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="LLM スタブの最初のトークンまでの遅延（秒）")
+    parser.add_argument("--jitter", type=float, default=0.05, help="遅延に加える乱数の幅（秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=2000, help="LLM スタブの出力速度（0 なら即時）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500 / ServiceUnavailable を返す確率")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="429 / ThrottlingException を返す確率")
+    parser.add_argument("--retry-after", type=int, default=1, help="スロットリング時の Retry-After（秒）")
+    parser.add_argument("--output", help="結果を JSON で保存するファイル")
+    parser.add_argument("--save-baseline", help="結果を比較用のベースラインとして保存するファイル")
+    parser.add_argument("--baseline", help="比較するベースラインのファイル")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="p95 の悪化を許容する割合")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="悪化とみなす最小の差（秒）")
+    args = parser.parse_args(argv)
+
+    ncbi_faults = Faults(args.ncbi_latency, args.jitter, args.error_rate, args.throttle_rate, args.retry_after)
+    llm_faults = Faults(args.llm_latency, args.jitter, args.error_rate, args.throttle_rate, args.retry_after,
+                        tokens_per_sec=args.tokens_per_sec)
+    server = StubServer(ncbi_faults=ncbi_faults, azure_faults=llm_faults).start()
+    workdir = tempfile.mkdtemp(prefix="bench-")
+
+    # 共有モジュールは読み込み時に設定を参照するので、環境変数を設定してから import する
+    os.environ.update({
+        "NCBI_EUTILS_BASE": server.eutils_base,
+        "NCBI_RATE_LIMIT": str(args.ncbi_rate or 1000000),
+        "CACHE_PATH": os.path.join(workdir, "cache.sqlite3"),
+        "api_base": server.base_url,
+        "deployment_name": "bench",
+        "api_key": "bench",
+    })
+    os.environ.setdefault("HTTP_POOL_SIZE", str(max(20, args.sessions * 2)))
+    # 段階ごとの処理時間は計測値から集計するので、すべての計測値を残す
+    os.environ.setdefault("METRICS_RECENT_SAMPLES", str(max(1000, args.sessions * args.questions * 10)))
+    import jobs
+    import llm
+    import metrics
+    import router
+
+    if args.model not in llm.MODELS and args.model != router.AUTO_MODEL:
+        parser.error(f"不明なモデルです: {args.model}")
+    for config in llm.MODELS.values():
+        if config.get("model_id_env"):
+            os.environ.setdefault(config["model_id_env"], "bench")
+    llm.set_bedrock_client(FakeBedrockClient(faults=llm_faults))
+
+    errors = ErrorCounter()
+    job_queue = jobs.JobQueue(max_workers=args.sessions)
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.summary_workers) as summary_executor, \
+                ThreadPoolExecutor(max_workers=args.sessions) as search_executor, \
+                ThreadPoolExecutor(max_workers=args.sessions) as sessions:
+            executors = (summary_executor, search_executor)
+            futures = [sessions.submit(run_session, s, args, job_queue, executors, errors)
+                       for s in range(args.sessions)]
+            succeeded = sum(future.result() for future in as_completed(futures))
+    finally:
+        server.stop()
+    elapsed = time.perf_counter() - started
+
+    total = args.sessions * args.questions
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "save_baseline", "baseline")},
+        "stages": stage_summary(),
+        "errors": errors.errors,
+        "requests": server.requests,
+        "questions": total,
+        "succeeded": succeeded,
+        "elapsed": elapsed,
+        "throughput": total / elapsed if elapsed else 0.0,
+        # トークン数・キャッシュヒット率・リトライ回数（アプリ側の計測値）
+        "metrics": metrics.get_metrics().snapshot(),
+    }
+    print_report(report)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.min_delta)
+        for stage, before, now in regressions:
+            print(f"[REGRESSION] {stage}: p95 {before:.3f} 秒 → {now:.3f} 秒", file=sys.stderr)
+        if regressions:
+            return 1
+        print("[INFO] ベースラインからの悪化はありません", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,363 @@
+import io
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# NCBI E-utilities / Bedrock / Azure OpenAI のローカルスタブ
+# 外部サービスに接続せずにパイプラインの遅延やスループットを測るために使う
+# 応答は入力から決まる疑似データで、遅延・エラー・スロットリングを一定の確率で注入できる
+
+
+# 遅延と障害の注入設定
+# - latency: 応答（ストリーミングなら最初のトークン）までの固定遅延（秒）、jitter: それに加える一様乱数の幅
+# - error_rate: 500 / ServiceUnavailable を返す確率、throttle_rate: 429 / ThrottlingException を返す確率
+# - tokens_per_sec: LLM の出力速度（0 なら出力時間はかからない）
+class Faults:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1,
+                 tokens_per_sec=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.tokens_per_sec = tokens_per_sec
+        self._random = random.Random()
+        self._lock = threading.Lock()
+
+    def delay(self):
+        with self._lock:
+            extra = self._random.uniform(0, self.jitter) if self.jitter else 0.0
+        time.sleep(self.latency + extra)
+
+    # 今回のリクエストで注入する障害（"throttle" / "error" / None）
+    def pick(self):
+        with self._lock:
+            r = self._random.random()
+        if r < self.throttle_rate:
+            return "throttle"
+        if r < self.throttle_rate + self.error_rate:
+            return "error"
+        return None
+
+    def token_time(self, tokens):
+        return tokens / self.tokens_per_sec if self.tokens_per_sec > 0 else 0.0
+
+
+def _stable_hash(text):
+    return zlib.crc32(text.encode("utf-8"))
+
+
+_WORDS = ("patients", "randomized", "trial", "outcome", "therapy", "cohort", "risk", "mortality",
+          "treatment", "efficacy", "safety", "analysis", "clinical", "study", "compared", "significant")
+
+
+def _sentence(seed, words):
+    rng = random.Random(seed)
+    return " ".join(rng.choice(_WORDS) for _ in range(words)).capitalize() + "."
+
+
+# efetch の Abstract に付けるセクションの見出し
+_SECTIONS = ("BACKGROUND", "METHODS", "RESULTS", "CONCLUSIONS")
+
+
+# 疑似的な論文データ（PMID から決まる）
+def fake_paper(pmid, abstract_words=250):
+    seed = int(pmid)
+    return {
+        "title": _sentence(seed, 10),
+        "authors": [{"name": f"Author{seed % 97} A"}, {"name": f"Author{seed % 89} B"}, {"name": f"Author{seed % 83} C"}],
+        "pubdate": f"{2015 + seed % 10} Jan",
+        "abstract": " ".join(_sentence(seed * 31 + i, 25) for i in range(max(1, abstract_words // 25))),
+    }
+
+
+# 検索語から決まる PMID の一覧
+def fake_pmids(term, retstart, retmax, count):
+    base = _stable_hash(term) % 9_000_000
+    end = min(count, retstart + retmax)
+    return [str(10_000_000 + (base + i * 7919) % 9_000_000) for i in range(retstart, end)]
+
+
+# LLM の疑似応答（システムプロンプトの内容でクエリ生成・一括要約・要約を見分ける）
+def fake_completion(system_prompt, prompt, summary_tokens=300):
+    if "検索クエリ" in system_prompt:
+        # 条件の厳しいものから緩いものの順に、検索式の候補を1行に1つずつ返す
+        word = _WORDS[_stable_hash(prompt) % len(_WORDS)]
+        return (f'("{word}"[tiab] OR "{prompt[:20]}"[tiab]) AND ("2020"[PDat] : "3000"[PDat])\n'
+                f'"{word}"[tiab] AND ("2020"[PDat] : "3000"[PDat])\n'
+                f'"{word}"[tiab]')
+    if '"summaries"' in system_prompt:
+        pmids = re.findall(r"--- PMID: (\d+) ---", prompt)
+        return json.dumps({"summaries": [
+            {"pmid": pmid, "summary": _fake_summary(pmid, summary_tokens)} for pmid in pmids
+        ]}, ensure_ascii=False)
+    return _fake_summary(prompt, summary_tokens)
+
+
+def _fake_summary(seed, tokens):
+    line = "・対象患者において治療効果が確認された。"
+    lines = max(1, tokens // len(line))
+    return "\n".join(f"{line}（{(_stable_hash(str(seed)) + i) % 100}）" for i in range(lines))
+
+
+# テキストをストリーミング用のかたまりに分ける（おおよそ chunk 文字ずつ）
+def split_chunks(text, chunk=10):
+    return [text[i:i + chunk] for i in range(0, len(text), chunk)]
+
+
+# ---------------------------------------------------------------------------
+# Bedrock runtime クライアントのスタブ（invoke_model / invoke_model_with_response_stream）
+class FakeBedrockClient:
+    def __init__(self, faults=None, summary_tokens=300):
+        self.faults = faults or Faults()
+        self.summary_tokens = summary_tokens
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _start(self, body, operation):
+        with self._lock:
+            self.calls += 1
+        request = json.loads(body)
+        fault = self.faults.pick()
+        self.faults.delay()
+        if fault:
+            from botocore.exceptions import ClientError
+            code = "ThrottlingException" if fault == "throttle" else "ServiceUnavailableException"
+            raise ClientError({"Error": {"Code": code, "Message": "injected by bench"}}, operation)
+        prompt = request["messages"][0]["content"]
+        text = fake_completion(request.get("system", ""), prompt, self.summary_tokens)
+        return request, prompt, text
+
+    def invoke_model(self, modelId, body, contentType=None, accept=None):
+        request, prompt, text = self._start(body, "InvokeModel")
+        time.sleep(self.faults.token_time(len(text)))
+        payload = {
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "usage": {"input_tokens": len(request.get("system", "")) + len(prompt), "output_tokens": len(text)},
+        }
+        return {"body": io.BytesIO(json.dumps(payload, ensure_ascii=False).encode("utf-8"))}
+
+    def invoke_model_with_response_stream(self, modelId, body, contentType=None, accept=None):
+        request, prompt, text = self._start(body, "InvokeModelWithResponseStream")
+        return {"body": self._events(request, prompt, text)}
+
+    def _events(self, request, prompt, text):
+        def event(data):
+            return {"chunk": {"bytes": json.dumps(data, ensure_ascii=False).encode("utf-8")}}
+
+        yield event({"type": "message_start", "message": {
+            "usage": {"input_tokens": len(request.get("system", "")) + len(prompt), "output_tokens": 0}}})
+        for chunk in split_chunks(text):
+            time.sleep(self.faults.token_time(len(chunk)))
+            yield event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}})
+        yield event({"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                     "usage": {"output_tokens": len(text)}})
+        yield event({"type": "message_stop"})
+
+
+# ---------------------------------------------------------------------------
+# NCBI E-utilities と Azure OpenAI chat/completions の HTTP スタブサーバー
+class StubServer:
+    def __init__(self, ncbi_faults=None, azure_faults=None, search_count=200, abstract_words=250,
+                 summary_tokens=300, host="127.0.0.1", port=0):
+        self.ncbi_faults = ncbi_faults or Faults()
+        self.azure_faults = azure_faults or Faults()
+        self.search_count = search_count
+        self.abstract_words = abstract_words
+        self.summary_tokens = summary_tokens
+        self.requests = {}
+        self.histories = {}  # WebEnv -> 検索語（usehistory=y の検索結果）
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def eutils_base(self):
+        return f"{self.base_url}/entrez/eutils"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="bench-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def count(self, name):
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _params(self):
+                params = parse_qs(urlparse(self.path).query)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                    params.update(parse_qs(body.decode("utf-8")))
+                return {k: v[0] for k, v in params.items()}, body
+
+            def _send(self, status, body, content_type="application/json", headers=None):
+                data = body.encode("utf-8") if isinstance(body, str) else body
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            # 障害を注入した場合は True を返す
+            def _inject(self, faults):
+                fault = faults.pick()
+                faults.delay()
+                if fault == "throttle":
+                    self._send(429, '{"error": "throttled"}', headers={"Retry-After": str(faults.retry_after)})
+                    return True
+                if fault == "error":
+                    self._send(500, '{"error": "injected"}')
+                    return True
+                return False
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                path = urlparse(self.path).path
+                params, body = self._params()
+                name = path.rsplit("/", 1)[-1].split(".")[0]
+                if path.startswith("/openai/"):
+                    name = "azure"
+                server.count(name)
+                handler = getattr(self, f"_handle_{name}", None)
+                if handler is None:
+                    self._send(404, '{"error": "not found"}')
+                    return
+                faults = server.azure_faults if name == "azure" else server.ncbi_faults
+                if self._inject(faults):
+                    return
+                handler(params, body)
+
+            def _handle_esearch(self, params, body):
+                retstart = int(params.get("retstart", 0))
+                retmax = int(params.get("retmax", 20))
+                term = params.get("term", "")
+                idlist = fake_pmids(term, retstart, retmax, server.search_count)
+                result = {"count": str(server.search_count), "retmax": str(len(idlist)),
+                          "retstart": str(retstart), "idlist": idlist}
+                if params.get("usehistory") == "y":
+                    webenv = f"STUB_{_stable_hash(term):08x}"
+                    with server._lock:
+                        server.histories[webenv] = term
+                    result.update(webenv=webenv, querykey="1")
+                self._send(200, json.dumps({"esearchresult": result}))
+
+            # id または WebEnv / query_key / retstart / retmax で指定された PMID
+            def _pmids(self, params):
+                if "WebEnv" in params:
+                    with server._lock:
+                        term = server.histories.get(params["WebEnv"])
+                    if term is None:
+                        return None
+                    return fake_pmids(term, int(params.get("retstart", 0)), int(params.get("retmax", 20)),
+                                      server.search_count)
+                return [p for p in params.get("id", "").split(",") if p]
+
+            def _handle_esummary(self, params, body):
+                pmids = self._pmids(params)
+                if pmids is None:
+                    self._send(200, json.dumps({"esummaryresult": ["Unable to obtain query #1"]}))
+                    return
+                result = {"uids": pmids}
+                for pmid in pmids:
+                    paper = fake_paper(pmid, server.abstract_words)
+                    result[pmid] = {"uid": pmid, "title": paper["title"], "authors": paper["authors"],
+                                    "pubdate": paper["pubdate"]}
+                self._send(200, json.dumps({"result": result}))
+
+            # retmode=xml の PubmedArticleSet（Abstract は見出し付きのセクションに分ける）
+            def _handle_efetch(self, params, body):
+                pmids = self._pmids(params) or []
+                articles = []
+                for pmid in pmids:
+                    paper = fake_paper(pmid, server.abstract_words)
+                    year, month = paper["pubdate"].split()
+                    authors = "".join(
+                        f"<Author><LastName>{a['name'].split()[0]}</LastName><Initials>{a['name'].split()[1]}</Initials></Author>"
+                        for a in paper["authors"])
+                    sentences = re.split(r"(?<=\.) ", paper["abstract"])
+                    step = max(1, -(-len(sentences) // len(_SECTIONS)))
+                    sections = "".join(
+                        f'<AbstractText Label="{label}" NlmCategory="{label}">{" ".join(sentences[i * step:(i + 1) * step])}</AbstractText>'
+                        for i, label in enumerate(_SECTIONS) if sentences[i * step:(i + 1) * step])
+                    mesh = "".join(f"<MeshHeading><DescriptorName>{w.capitalize()}</DescriptorName></MeshHeading>"
+                                   for w in paper["title"].lower().rstrip(".").split()[:3])
+                    articles.append(
+                        f"<PubmedArticle><MedlineCitation><PMID>{pmid}</PMID><Article>"
+                        f"<Journal><JournalIssue><PubDate><Year>{year}</Year><Month>{month}</Month></PubDate></JournalIssue>"
+                        f"<Title>Journal of Stub Medicine</Title><ISOAbbreviation>J Stub Med</ISOAbbreviation></Journal>"
+                        f"<ArticleTitle>{paper['title']}</ArticleTitle><Abstract>{sections}</Abstract>"
+                        f"<AuthorList>{authors}</AuthorList>"
+                        f"<PublicationTypeList><PublicationType>Journal Article</PublicationType></PublicationTypeList>"
+                        f"</Article><MeshHeadingList>{mesh}</MeshHeadingList></MedlineCitation></PubmedArticle>")
+                self._send(200, f'<?xml version="1.0"?><PubmedArticleSet>{"".join(articles)}</PubmedArticleSet>',
+                           content_type="text/xml; charset=utf-8")
+
+            def _handle_azure(self, params, body):
+                request = json.loads(body or b"{}")
+                messages = request.get("messages", [])
+                system_prompt = next((m["content"] for m in messages if m["role"] == "system"), "")
+                prompt = next((m["content"] for m in messages if m["role"] == "user"), "")
+                text = fake_completion(system_prompt, prompt, server.summary_tokens)
+                faults = server.azure_faults
+                if not request.get("stream"):
+                    time.sleep(faults.token_time(len(text)))
+                    self._send(200, json.dumps({
+                        "choices": [{"message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": len(system_prompt) + len(prompt), "completion_tokens": len(text)},
+                    }, ensure_ascii=False))
+                    return
+                # SSE はチャンク転送で少しずつ送る
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                events = [{"choices": [{"delta": {"role": "assistant"}}]}]
+                events += [{"choices": [{"delta": {"content": chunk}}]} for chunk in split_chunks(text)]
+                for i, data in enumerate(events):
+                    if i:
+                        time.sleep(faults.token_time(len(data["choices"][0]["delta"]["content"])))
+                    self._write_chunk(f"data: {json.dumps(data, ensure_ascii=False)}\n\n")
+                self._write_chunk(f"data: {json.dumps({'choices': [{'delta': {}, 'finish_reason': 'stop'}]})}\n\n")
+                self._write_chunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _write_chunk(self, text):
+                data = text.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# 永続キャッシュの設定（.env または環境変数から）
+CACHE_PATH = os.getenv("CACHE_PATH", "cache.sqlite3")
+PUBMED_CACHE_TTL = float(os.getenv("PUBMED_CACHE_TTL", str(30 * 24 * 3600)))  # 秒（既定は30日）
+PUBMED_CACHE_MAX_ENTRIES = int(os.getenv("PUBMED_CACHE_MAX_ENTRIES", "100000"))
+SUMMARY_CACHE_TTL = float(os.getenv("SUMMARY_CACHE_TTL", str(30 * 24 * 3600)))  # 秒（既定は30日）
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "100000"))
+BLOB_CACHE_MAX_ENTRIES = int(os.getenv("BLOB_CACHE_MAX_ENTRIES", "500000"))
+# 値を変えると、プロンプトが同じでも保存済みの要約をすべて使わなくなる
+SUMMARY_CACHE_EPOCH = os.getenv("SUMMARY_CACHE_EPOCH", "1")
+# 期限の無いキャッシュで、読み出し時に最終アクセス時刻を更新する間隔（秒）
+# 期限のあるキャッシュは ttl の 1/10 ごとに更新する（上限超過時の削除の順序が少し粗くなるだけ）
+CACHE_TOUCH_INTERVAL = float(os.getenv("CACHE_TOUCH_INTERVAL", str(24 * 3600)))
+
+
+# 失敗したトランザクションを取り消す（SQLite が既に取り消している場合は何もしない）
+def rollback(conn):
+    if conn.in_transaction:
+        conn.execute("ROLLBACK")
+
+
+# SQLite を使ったキー・バリュー型の永続キャッシュ
+# - 値は JSON で保存する
+# - ttl 秒を過ぎたエントリはヒットしない（0 以下なら無期限）
+# - max_entries を超えたら最終アクセスが古いものから削除する
+# - 最終アクセス時刻は前回の更新から touch_interval 秒を過ぎたときだけ書き込む（読み出しのたびに書き込まない）
+# 複数のアプリ（aws.py / aws2.py / chat.py）から同じファイルを共有できるよう WAL モードで開く
+class SQLiteCache:
+    def __init__(self, path, table, ttl=0, max_entries=0):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.touch_interval = ttl / 10 if ttl > 0 else CACHE_TOUCH_INTERVAL
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed_at)")
+
+    # 複数キーをまとめて取得し、ヒットしたものだけを dict で返す
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        now = time.time()
+        hits = {}
+        stale = []
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, value, created_at, accessed_at FROM {self.table} WHERE key IN ({marks})", chunk
+                ).fetchall()
+                for key, value, created_at, accessed_at in rows:
+                    if self.ttl > 0 and now - created_at > self.ttl:
+                        continue
+                    hits[key] = json.loads(value)
+                    if now - accessed_at > self.touch_interval:
+                        stale.append(key)
+            if stale:
+                self._conn.executemany(
+                    f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", [(now, k) for k in stale]
+                )
+        return hits
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    # 複数の値をまとめて保存する
+    def set_many(self, items):
+        items = dict(items)
+        if not items:
+            return
+        now = time.time()
+        rows = [(k, json.dumps(v, ensure_ascii=False), now, now) for k, v in items.items()]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)", rows
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                # ロック待ちのタイムアウトなどで失敗した場合、トランザクションを残すと以後の書き込みがすべて失敗する
+                rollback(self._conn)
+                raise
+            self._writes += len(rows)
+            # 件数の確認は書き込み量が上限の1%に達するごとに行う
+            if self.max_entries > 0 and self._writes >= max(1, self.max_entries // 100):
+                self._writes = 0
+                self._evict()
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    # キーが prefix で始まるエントリをまとめて削除する
+    def delete_prefix(self, prefix):
+        pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key LIKE ? ESCAPE '\\'", (pattern,))
+
+    # キーがいずれの prefix でも始まらないエントリを削除する
+    def retain_prefixes(self, prefixes):
+        prefixes = list(prefixes)
+        if not prefixes:
+            return self.clear()
+        conditions = " AND ".join(["substr(key, 1, ?) != ?"] * len(prefixes))
+        params = [x for p in prefixes for x in (len(p), p)]
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE {conditions}", params)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table}")
+
+    # 期限切れと上限超過分を削除する（呼び出し側でロックを取得済みであること）
+    def _evict(self):
+        if self.ttl > 0:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (time.time() - self.ttl,))
+        self._conn.execute(
+            f"DELETE FROM {self.table} WHERE key IN ("
+            f"SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# テーブルごとのキャッシュをプロセス内で1つだけ作って返す
+def _get_cache(table, ttl, max_entries):
+    with _caches_lock:
+        cache = _caches.get(table)
+        if cache is None:
+            cache = SQLiteCache(CACHE_PATH, table, ttl=ttl, max_entries=max_entries)
+            _caches[table] = cache
+        return cache
+
+
+# PMID をキーに、整形済みの論文情報（title/authors/pubdate/abstract など）を保存するキャッシュ
+def get_pubmed_cache():
+    return _get_cache("pubmed_records", PUBMED_CACHE_TTL, PUBMED_CACHE_MAX_ENTRIES)
+
+
+# 要約（PMID × モデル × プロンプト/生成パラメータ）を保存するキャッシュ
+def get_summary_cache():
+    return _get_cache("summaries", SUMMARY_CACHE_TTL, SUMMARY_CACHE_MAX_ENTRIES)
+
+
+# 会話履歴が参照する本文（要約・論文情報）を内容のハッシュで保存するストア（期限なし）
+def get_blob_cache():
+    return _get_cache("blobs", 0, BLOB_CACHE_MAX_ENTRIES)
+
+
+# システムプロンプトと生成パラメータからプロンプトのバージョン（ハッシュ）を求める
+# プロンプトの文言やパラメータを変えると別のバージョンになり、古い要約はヒットしなくなる
+def prompt_version(system_prompt, params):
+    payload = json.dumps([SUMMARY_CACHE_EPOCH, system_prompt, params], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def summary_cache_key(pmid, model, version):
+    return f"{version}|{model}|{pmid}"
+
+
+# 要約キャッシュを明示的に無効化する
+# version を指定するとそのバージョンだけ、model も指定するとさらにそのモデルだけを削除する
+def invalidate_summaries(version=None, model=None):
+    cache = get_summary_cache()
+    if version is None:
+        cache.clear()
+    elif model is None:
+        cache.delete_prefix(f"{version}|")
+    else:
+        cache.delete_prefix(f"{version}|{model}|")
+
+
+# 現在使っているバージョン以外の要約を削除する（プロンプト変更後に古い要約を一掃する）
+def purge_stale_summaries(current_versions):
+    get_summary_cache().retain_prefixes([f"{v}|" for v in current_versions])
@@ -1,12 +1,15 @@
 ﻿import streamlit as st
-import requests
-import os
-import time
+import llm
+from query_cache import get_query_cache
+from pubmed import search_pubmed, fetch_pubmed_metadata_batch
 
-# APIキーとエンドポイント設定（.env または環境変数から）
-api_key = os.getenv("api_key")
-endpoint = os.getenv("api_base")
-deployment_name = os.getenv("deployment_name")
+# 使用するモデル（APIキーとエンドポイントは llm.py が .env または環境変数から読む）
+model = "Azure OpenAI"
+
+# 要約用のシステムプロンプト（通常版とストリーミング版で共通）
+SUMMARY_SYSTEM_PROMPT = """
+PubMedから取得したAbstractです。日本語で、情報量を落とさずに圧縮してください。
+"""
 
 # PubMed検索用クエリをGPTで生成
 def ask_gpt_for_pubmed_query(user_input):
@@ -19,81 +22,40 @@ def ask_gpt_for_pubmed_query(user_input):
 2. クエリはPubMedの検索構文に従い、論理演算子（AND, OR）を使用してください。
 3. 基本形式: (疾患名 OR 同義語) AND (目的) AND (対象) AND ("2020"[PDat] : "3000"[PDat])
 """
-    headers = {
-        "api-key": api_key,
-        "Content-Type": "application/json"
-    }
-    url = f"{endpoint}/openai/deployments/{deployment_name}/chat/completions?api-version=2023-05-15"
-    data = {
-        "messages": [
-            {"role": "system", "content": system_input},
-            {"role": "user", "content": user_input}
-        ],
-        "max_tokens": 16384,
-        "temperature": 0.5
-    }
-    response = requests.post(url, headers=headers, json=data)
-    return response.json()['choices'][0]['message']['content'].strip()
-
-# PubMed検索
-def search_pubmed(query, max_results=3):
-    url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-    params = {
-        "db": "pubmed",
-        "term": query,
-        "retmode": "json",
-        "retmax": max_results
-    }
-    res = requests.get(url, params=params).json()
-    return res.get('esearchresult', {}).get('idlist', [])
-
-# PubMedから論文情報とAbstract取得
-def fetch_pubmed_metadata(pmid):
-    summary_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi"
-    abstract_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
-
-    summary = requests.get(summary_url, params={"db": "pubmed", "id": pmid, "retmode": "json"}).json()
-    doc = summary["result"][pmid]
-
-    abstract_res = requests.get(abstract_url, params={"db": "pubmed", "id": pmid, "retmode": "text", "rettype": "abstract"})
-    abstract_text = abstract_res.text.strip()
-
-    return {
-        "title": doc.get("title", ""),
-        "authors": ", ".join([a["name"] for a in doc.get("authors", [])[:3]]),
-        "pubdate": doc.get("pubdate", ""),
-        "url": f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/",
-        "abstract": abstract_text
-    }
+    # 似た質問に対して生成済みのクエリがあれば、それを使う
+    query_cache = get_query_cache()
+    cached = query_cache.get(user_input, model)
+    if cached is not None:
+        return cached
+
+    query = llm.complete(model, user_input, system_input).text
+    if query:
+        query_cache.put(user_input, query, model)
+    return query
 
 # AbstractをGPTで日本語要約
 def summarize_in_japanese(abstract_text):
     # system_input = "以下はPubMedから取得したAbstractです。日本語で2〜3行で簡潔に要約してください。"
-    system_input = f"""
-PubMedから取得したAbstractです。日本語で、情報量を落とさずに圧縮してください。
-"""
     prompt = f"--- Abstract ---\n{abstract_text}"
 
-    headers = {
-        "api-key": api_key,
-        "Content-Type": "application/json"
-    }
-    url = f"{endpoint}/openai/deployments/{deployment_name}/chat/completions?api-version=2023-05-15"
-    data = {
-        "messages": [
-            {"role": "system", "content": system_input},
-            {"role": "user", "content": prompt}
-        ],
-        "max_tokens": 16384,
-        "temperature": 0.5
-    }
-
     try:
-        response = requests.post(url, headers=headers, json=data)
-        return response.json()['choices'][0]['message']['content'].strip()
+        return llm.complete(model, prompt, SUMMARY_SYSTEM_PROMPT).text
     except:
         return "要約に失敗しました。"
 
+# AbstractをGPTで日本語要約（ストリーミング版、生成されたテキストを少しずつ返す）
+def summarize_in_japanese_stream(abstract_text):
+    prompt = f"--- Abstract ---\n{abstract_text}"
+
+    received = False
+    try:
+        for text in llm.stream(model, prompt, SUMMARY_SYSTEM_PROMPT):
+            received = True
+            yield text
+    except Exception:
+        if not received:
+            yield "要約に失敗しました。"
+
 # Streamlitアプリ本体
 st.set_page_config(page_title="医療文献検索AI", layout="wide")
 st.title("🧠 医療文献検索チャット (PubMed + GPT)")
@@ -115,18 +77,22 @@ if user_input:
         if not pmids:
             st.error("❌ 該当する論文が見つかりませんでした。")
         else:
-            for pmid in pmids:
-                time.sleep(1)  # API負荷対策
-                data = fetch_pubmed_metadata(pmid)
+            with st.spinner("📄 論文情報を取得中..."):
+                papers = fetch_pubmed_metadata_batch(pmids)
 
+            for data in papers:
                 st.markdown("----")
                 st.subheader(f"📄 {data['title']}")
                 st.markdown(f"👨‍⚕️ **著者:** {data['authors']}　｜　📅 **発表日:** {data['pubdate']}")
                 st.markdown(f"🔗 [PubMedリンクはこちら]({data['url']})")
 
                 if data['abstract']:
-                    with st.spinner("📝 要約生成中..."):
-                        summary = summarize_in_japanese(data['abstract'])
-                    st.success(f"📝 要約: {summary}")
+                    placeholder = st.empty()
+                    placeholder.info("📝 要約生成中...")
+                    summary = ""
+                    for text in summarize_in_japanese_stream(data['abstract']):
+                        summary += text
+                        placeholder.success(f"📝 要約: {summary}▌")
+                    placeholder.success(f"📝 要約: {summary.strip()}")
                 else:
                     st.warning("⚠️ この論文にはAbstractが含まれていません。")
\ No newline at end of file
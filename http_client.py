@@ -0,0 +1,102 @@
+import email.utils
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+# 接続プールの大きさ（同時に張っておく keep-alive 接続の数）
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+# リトライ設定
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))  # 秒
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "20"))  # 秒
+
+# エンドポイントごとのタイムアウト（接続, 読み込み）秒
+TIMEOUTS = {
+    "esearch": (3.05, 15),
+    "esummary": (3.05, 20),
+    "efetch": (3.05, 30),
+    "azure": (3.05, 120),
+}
+DEFAULT_TIMEOUT = (3.05, 30)
+
+# リトライ対象のステータスコード
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+# プロセス全体で共有する HTTP セッション（keep-alive で接続を使い回す）
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            _session = session
+        return _session
+
+
+# Retry-After ヘッダー（秒数または HTTP 日付）を待ち時間（秒）に変換する
+def _retry_after(response):
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# 指数バックオフ（full jitter）。Retry-After があればそちらを優先する
+def _backoff(attempt, response=None):
+    wait = _retry_after(response)
+    if wait is None:
+        wait = random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+    return min(wait, HTTP_BACKOFF_MAX)
+
+
+# 共有セッションでリクエストを送る
+# - endpoint 名に応じたタイムアウトを使う（timeout を渡せば上書き）
+# - 429/5xx と接続エラー・タイムアウトはバックオフしてリトライする
+# - before_attempt を渡すと各試行の直前に呼ぶ（レート制限の取得など）
+# リトライし尽くした場合は最後のレスポンスを返す（例外の場合はそのまま送出する）
+# 試行ごとのステータスとリトライ回数は metrics に記録する
+def request(method, url, endpoint=None, max_retries=HTTP_MAX_RETRIES, before_attempt=None, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+    session = get_session()
+    label = endpoint or "other"
+    attempt = 0
+    while True:
+        if before_attempt is not None:
+            before_attempt()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.inc("http_requests_total", endpoint=label, status=type(e).__name__)
+            if attempt >= max_retries:
+                raise
+            metrics.inc("http_retries_total", endpoint=label, reason=type(e).__name__)
+            time.sleep(_backoff(attempt))
+            attempt += 1
+            continue
+
+        metrics.inc("http_requests_total", endpoint=label, status=str(response.status_code))
+        if response.status_code not in RETRY_STATUSES or attempt >= max_retries:
+            return response
+        metrics.inc("http_retries_total", endpoint=label, reason=str(response.status_code))
+        wait = _backoff(attempt, response)
+        response.close()
+        time.sleep(wait)
+        attempt += 1
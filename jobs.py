@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+# 時間のかかる処理（クエリ生成 → 検索 → 論文取得 → 要約）をバックグラウンドのジョブとして実行する
+# - 画面（Streamlit のスクリプト）はジョブ ID だけを持ち、途中経過を読み出して表示する
+# - 画面の再実行やウィジェットの操作でスクリプトが止まっても、ジョブは最後まで実行される
+# - 完了したジョブは受け取られるまで（最長 JOB_RETENTION 秒）結果を保持する
+
+# 同時に実行するジョブの数（それ以上は順番待ちになる）
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "8"))
+# 完了後に受け取られないジョブを保持する時間（秒）
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "3600"))
+
+
+class Job:
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"  # queued / running / done / error
+        self.progress = ""  # 画面に表示する途中経過の文言
+        self.preview = []  # 結果が揃うまでの仮の表示（ローカル検索でヒットした論文など）
+        self.blocks = []  # 応答ブロック（aws2.py の render_blocks で表示する形）
+        self.result = None  # ジョブの関数の戻り値
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "error")
+
+    def set_progress(self, progress, preview=None):
+        with self._lock:
+            self.progress = progress
+            if preview is not None:
+                self.preview = list(preview)
+
+    # 応答ブロックを追加し、その位置を返す
+    def add_block(self, block):
+        with self._lock:
+            self.blocks.append(dict(block))
+            return len(self.blocks) - 1
+
+    def update_block(self, index, **fields):
+        with self._lock:
+            self.blocks[index].update(fields)
+
+    # ブロックの文字列の項目にテキストを追記する（ストリーミングの要約など）
+    def append_text(self, index, field, text):
+        with self._lock:
+            self.blocks[index][field] += text
+
+    def get_block(self, index):
+        with self._lock:
+            return dict(self.blocks[index])
+
+    # 画面の表示用に、その時点の状態を複製して返す
+    def snapshot(self):
+        with self._lock:
+            return {
+                "id": self.id,
+                "kind": self.kind,
+                "status": self.status,
+                "progress": self.progress,
+                "preview": list(self.preview),
+                "blocks": [dict(b) for b in self.blocks],
+                "result": self.result,
+                "error": self.error,
+            }
+
+
+class JobQueue:
+    def __init__(self, max_workers=JOB_MAX_WORKERS, retention=JOB_RETENTION):
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    # fn(job, *args) をジョブとして実行し、ジョブ ID を返す
+    # fn は job.add_block などで途中経過を書き込み、最終的な結果を戻り値で返す
+    def submit(self, kind, fn, *args):
+        job = Job(kind)
+        with self._lock:
+            self._evict()
+            self._jobs[job.id] = job
+        metrics.inc("jobs_total", kind=kind, status="submitted")
+        self._executor.submit(self._run, job, fn, args)
+        return job.id
+
+    def _run(self, job, fn, args):
+        with job._lock:
+            job.status = "running"
+        metrics.observe("job_wait_seconds", time.time() - job.created_at, kind=job.kind)
+        try:
+            result = fn(job, *args)
+        except Exception as e:
+            print(f"[WARN] ジョブ {job.kind} ({job.id}) が失敗しました: {e}")
+            with job._lock:
+                job.status, job.error = "error", str(e)
+        else:
+            with job._lock:
+                job.status, job.result = "done", result
+        with job._lock:
+            job.finished_at = time.time()
+            job.progress = ""
+            job.preview = []
+        metrics.inc("jobs_total", kind=job.kind, status=job.status)
+        metrics.observe("job_seconds", job.finished_at - job.created_at, kind=job.kind)
+        job._done.set()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # ジョブの完了を待って受け取る（timeout 秒以内に完了しない・存在しない場合は None）
+    # 画面の無い呼び出し側（負荷試験など）向け。画面からは collect で途中経過を読みながら受け取る
+    def wait(self, job_id, timeout=None):
+        job = self.get(job_id)
+        if job is None or not job._done.wait(timeout):
+            return None
+        return self.collect(job_id)
+
+    # 完了したジョブを受け取って一覧から外す（未完了・存在しない場合は None）
+    def collect(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or not job.finished:
+                return None
+            return self._jobs.pop(job_id)
+
+    # 完了してから retention 秒を過ぎたジョブを削除する（ロック取得済みで呼び出すこと）
+    def _evict(self):
+        deadline = time.time() - self.retention
+        for job_id in [i for i, job in self._jobs.items() if job.finished_at and job.finished_at < deadline]:
+            del self._jobs[job_id]
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+# プロセス全体で共有するジョブキュー
+def get_job_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
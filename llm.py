@@ -0,0 +1,451 @@
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import http_client
+import metrics
+from ratelimit import AdaptiveLimiter
+
+# 利用できるモデルの設定
+# モデルを追加する場合はここにエントリを足すだけでよい
+# - provider: "bedrock" または "azure"
+# - model_id / model_id_env: Bedrock のモデル ID（推論プロファイル ARN）またはそれを入れた環境変数名
+# - max_tokens / temperature: 生成パラメータの既定値
+# - selectable: aws2.py のサイドバーに表示するかどうか
+MODELS = {
+    "Claude 3 Sonnet": {
+        "provider": "bedrock",
+        "model_id_env": "BEDROCK_INFERENCE_PROFILE_ARN_3",
+        "max_tokens": 1024,
+        "temperature": 0,
+        "selectable": True,
+    },
+    "Claude 3.7 Sonnet": {
+        "provider": "bedrock",
+        "model_id_env": "BEDROCK_INFERENCE_PROFILE_ARN_37",
+        "max_tokens": 16384,  # 通常は 1024〜4096 程度が適切
+        "temperature": 0,
+        "selectable": True,
+    },
+    "Claude Sonnet 4": {
+        "provider": "bedrock",
+        "model_id_env": "BEDROCK_INFERENCE_PROFILE_ARN_4",
+        "max_tokens": 16384,
+        "temperature": 0,
+        "selectable": True,
+    },
+    # aws.py で使っているオンデマンドのモデル ID
+    "Claude 3 Sonnet (オンデマンド)": {
+        "provider": "bedrock",
+        "model_id": "anthropic.claude-3-sonnet-20240229-v1:0",
+        "max_tokens": 1024,
+        "temperature": 0.5,
+        "selectable": False,
+    },
+    # chat.py で使っている Azure OpenAI のデプロイ
+    "Azure OpenAI": {
+        "provider": "azure",
+        "max_tokens": 16384,
+        "temperature": 0.5,
+        "selectable": False,
+    },
+}
+DEFAULT_MODEL = "Claude Sonnet 4"
+
+# Bedrock クライアントの設定
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.getenv("BEDROCK_MAX_POOL_CONNECTIONS", "50"))
+BEDROCK_MAX_ATTEMPTS = int(os.getenv("BEDROCK_MAX_ATTEMPTS", "4"))
+BEDROCK_CONNECT_TIMEOUT = float(os.getenv("BEDROCK_CONNECT_TIMEOUT", "5"))
+BEDROCK_READ_TIMEOUT = float(os.getenv("BEDROCK_READ_TIMEOUT", "300"))
+
+# 推論プロファイルごとの同時実行数（AIMD で自動調整する。初期値・下限・上限）
+BEDROCK_CONCURRENCY_INITIAL = int(os.getenv("BEDROCK_CONCURRENCY_INITIAL", "8"))
+BEDROCK_CONCURRENCY_MIN = int(os.getenv("BEDROCK_CONCURRENCY_MIN", "1"))
+BEDROCK_CONCURRENCY_MAX = int(os.getenv("BEDROCK_CONCURRENCY_MAX", "32"))
+# 実行枠が空くのを待つ時間の上限（秒）
+BEDROCK_SLOT_TIMEOUT = float(os.getenv("BEDROCK_SLOT_TIMEOUT", "120"))
+# スロットリング（botocore のリトライ後も失敗したもの）をやり直す回数
+BEDROCK_THROTTLE_RETRIES = int(os.getenv("BEDROCK_THROTTLE_RETRIES", "4"))
+# スロットリングが続く推論プロファイルを避けて、他のモデルの推論プロファイルに切り替えるかどうか
+BEDROCK_FAILOVER = os.getenv("BEDROCK_FAILOVER", "1") != "0"
+# 切り替え先の候補（先頭ほど優先。推論プロファイル ARN が設定されているものだけを使う）
+FAILOVER_MODELS = ["Claude Sonnet 4", "Claude 3.7 Sonnet", "Claude 3 Sonnet"]
+# スロットリング・一時的な障害として扱う Bedrock のエラーコード
+THROTTLE_ERRORS = {"ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException",
+                   "ModelNotReadyException"}
+
+# 出力が max_tokens で打ち切られたことを表す stop_reason（Bedrock）/ finish_reason（Azure OpenAI）
+TRUNCATED_STOP_REASONS = ("max_tokens", "length")
+
+# Azure OpenAI の設定（.env または環境変数から）
+AZURE_API_VERSION = "2023-05-15"
+
+
+# 1回の呼び出し結果（プロバイダーによらず同じ形で返す）
+@dataclass
+class LLMResult:
+    text: str
+    model: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    stop_reason: str = ""
+
+
+# トークン数の概算（英語は約4文字で1トークン、日本語などの非 ASCII 文字は1文字1トークンとして数える）
+def estimate_tokens(text):
+    non_ascii = sum(1 for c in text if ord(c) > 127)
+    return (len(text) - non_ascii) // 4 + non_ascii + 1
+
+
+# aws2.py のサイドバーに表示するモデル名の一覧
+def selectable_models():
+    return [name for name, config in MODELS.items() if config.get("selectable")]
+
+
+# モデルの既定の生成パラメータ
+def get_generation_params(model):
+    config = MODELS[model]
+    return {"max_tokens": config["max_tokens"], "temperature": config["temperature"]}
+
+
+# Bedrock のモデル ID（推論プロファイル ARN）
+def get_inference_profile_arn(model):
+    config = MODELS[model]
+    return config.get("model_id") or os.getenv(config.get("model_id_env", ""), "")
+
+
+_bedrock = None
+_bedrock_lock = threading.Lock()
+
+
+# Bedrock クライアントはプロセス内で1つだけ作り、Streamlit の再実行やセッションをまたいで使い回す
+def get_bedrock_client():
+    global _bedrock
+    with _bedrock_lock:
+        if _bedrock is None:
+            _bedrock = boto3.client(
+                service_name="bedrock-runtime",
+                region_name=os.getenv("AWS_REGION", "ap-northeast-1"),
+                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                config=Config(
+                    max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS,
+                    retries={"mode": "adaptive", "max_attempts": BEDROCK_MAX_ATTEMPTS},
+                    connect_timeout=BEDROCK_CONNECT_TIMEOUT,
+                    read_timeout=BEDROCK_READ_TIMEOUT,
+                ),
+            )
+        return _bedrock
+
+
+# Bedrock クライアントを差し替える（ベンチマークでローカルのスタブを使う場合など）
+def set_bedrock_client(client):
+    global _bedrock
+    with _bedrock_lock:
+        _bedrock = client
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+# 推論プロファイルごとの同時実行数の制御（プロセス内の全セッション・全スレッドで共有）
+def get_limiter(model):
+    arn = get_inference_profile_arn(model)
+    with _limiters_lock:
+        limiter = _limiters.get(arn)
+        if limiter is None:
+            limiter = AdaptiveLimiter(BEDROCK_CONCURRENCY_INITIAL, BEDROCK_CONCURRENCY_MIN, BEDROCK_CONCURRENCY_MAX)
+            limiter.model = model
+            _limiters[arn] = limiter
+        return limiter
+
+
+# 診断パネル向けの、推論プロファイルごとの現在の同時実行数の上限と実行中の数
+def limiter_snapshot():
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return [{"model": l.model, "limit": int(l.limit), "in_flight": l.in_flight, "throttled": l.is_throttled()}
+            for l in limiters]
+
+
+def _is_throttle(e):
+    code = e.response.get("Error", {}).get("Code", "")
+    # ストリーミング中のエラーイベントは throttlingException のように先頭が小文字になる
+    return code[:1].upper() + code[1:] in THROTTLE_ERRORS
+
+
+# スロットリングが続いている場合に、代わりに使うモデルを返す（切り替えない場合は model のまま）
+# 切り替え先は、推論プロファイルが異なり混雑していないもののうち、空いている実行枠が最も多いもの
+def _pick_bedrock_model(model):
+    if not BEDROCK_FAILOVER or not get_limiter(model).is_throttled():
+        return model
+    arn = get_inference_profile_arn(model)
+    candidates = [m for m in FAILOVER_MODELS
+                  if m in MODELS and get_inference_profile_arn(m) not in ("", arn) and not get_limiter(m).is_throttled()]
+    if not candidates:
+        return model
+    chosen = max(candidates, key=lambda m: get_limiter(m).headroom())
+    metrics.inc("llm_failovers_total", model=model, to=chosen)
+    return chosen
+
+
+# 切り替え先のモデルで使う生成パラメータ（max_tokens は切り替え先の既定値を超えないようにする）
+def _failover_params(model, target, params):
+    if target == model or "max_tokens" not in params:
+        return params
+    return {**params, "max_tokens": min(params["max_tokens"], MODELS[target]["max_tokens"])}
+
+
+def _acquire_slot(model, limiter):
+    started = time.perf_counter()
+    if not limiter.acquire(BEDROCK_SLOT_TIMEOUT):
+        raise TimeoutError(f"{model}: {BEDROCK_SLOT_TIMEOUT} 秒待っても実行枠が空きませんでした")
+    metrics.observe("llm_slot_wait_seconds", time.perf_counter() - started, model=model)
+
+
+# スロットリング後にやり直すまでの待ち時間（指数バックオフ＋ジッター）
+def _throttle_backoff(attempt):
+    time.sleep(random.uniform(0, min(8.0, 0.5 * 2 ** attempt)))
+
+
+# Bedrock（Anthropic Messages API）のリクエストボディ
+def _bedrock_body(prompt, system_prompt, params):
+    return json.dumps({
+        "anthropic_version": "bedrock-2023-05-31",  # Claude 用必須
+        "system": system_prompt,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        **params
+    })
+
+
+def _complete_bedrock(model, prompt, system_prompt, params):
+    response = get_bedrock_client().invoke_model(
+        modelId=get_inference_profile_arn(model),
+        contentType="application/json",
+        accept="application/json",
+        body=_bedrock_body(prompt, system_prompt, params),
+    )
+    _record_bedrock_retries(model, response)
+    result = json.loads(response["body"].read())
+    usage = result.get("usage", {})
+    return LLMResult(
+        text="".join(c.get("text", "") for c in result.get("content", [])).strip(),
+        model=model,
+        input_tokens=usage.get("input_tokens", 0),
+        output_tokens=usage.get("output_tokens", 0),
+        stop_reason=result.get("stop_reason") or "",
+    )
+
+
+# usage には message_start / message_delta イベントのトークン数と stop_reason を入れる
+def _stream_bedrock(model, prompt, system_prompt, params, usage):
+    response = get_bedrock_client().invoke_model_with_response_stream(
+        modelId=get_inference_profile_arn(model),
+        contentType="application/json",
+        accept="application/json",
+        body=_bedrock_body(prompt, system_prompt, params),
+    )
+    _record_bedrock_retries(model, response)
+    for event in response["body"]:
+        chunk = event.get("chunk")
+        if not chunk:
+            continue
+        data = json.loads(chunk["bytes"])
+        if data.get("type") == "message_start":
+            usage["input_tokens"] = data.get("message", {}).get("usage", {}).get("input_tokens", 0)
+        elif data.get("type") == "message_delta":
+            usage["output_tokens"] = data.get("usage", {}).get("output_tokens", 0)
+            usage["stop_reason"] = data.get("delta", {}).get("stop_reason") or ""
+        elif data.get("type") == "content_block_delta":
+            text = data.get("delta", {}).get("text")
+            if text:
+                yield text
+
+
+# botocore が内部でリトライした回数（ResponseMetadata.RetryAttempts）を記録する
+def _record_bedrock_retries(model, response):
+    retries = response.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    if retries:
+        metrics.inc("llm_retries_total", retries, model=model)
+
+
+# Azure OpenAI の chat/completions エンドポイントへのリクエスト
+def _azure_request(prompt, system_prompt, params, stream):
+    url = f"{os.getenv('api_base')}/openai/deployments/{os.getenv('deployment_name')}/chat/completions?api-version={AZURE_API_VERSION}"
+    headers = {
+        "api-key": os.getenv("api_key"),
+        "Content-Type": "application/json"
+    }
+    data = {
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ],
+        **params
+    }
+    if stream:
+        data["stream"] = True
+    response = http_client.request("POST", url, endpoint="azure", headers=headers, json=data, stream=stream)
+    response.raise_for_status()
+    return response
+
+
+def _complete_azure(model, prompt, system_prompt, params):
+    result = _azure_request(prompt, system_prompt, params, stream=False).json()
+    choice = result["choices"][0]
+    usage = result.get("usage", {})
+    return LLMResult(
+        text=choice["message"]["content"].strip(),
+        model=model,
+        input_tokens=usage.get("prompt_tokens", 0),
+        output_tokens=usage.get("completion_tokens", 0),
+        stop_reason=choice.get("finish_reason") or "",
+    )
+
+
+# SSE（stream=True）応答から差分テキストを順に取り出す
+# この API バージョンの SSE にはトークン数が含まれないので、usage には概算を入れる（finish_reason は stop_reason に入れる）
+def _stream_azure(model, prompt, system_prompt, params, usage):
+    response = _azure_request(prompt, system_prompt, params, stream=True)
+    usage["input_tokens"] = estimate_tokens(system_prompt + prompt)
+    received = []
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+            choices = json.loads(payload).get("choices") or []
+            if choices:
+                if choices[0].get("finish_reason"):
+                    usage["stop_reason"] = choices[0]["finish_reason"]
+                text = choices[0].get("delta", {}).get("content")
+                if text:
+                    received.append(text)
+                    yield text
+    finally:
+        usage["output_tokens"] = estimate_tokens("".join(received))
+
+
+_PROVIDERS = {
+    "bedrock": (_complete_bedrock, _stream_bedrock),
+    "azure": (_complete_azure, _stream_azure),
+}
+
+
+# 呼び出し回数とトークン数を記録する
+def _record_usage(model, mode, status, input_tokens=0, output_tokens=0):
+    metrics.inc("llm_requests_total", model=model, mode=mode, status=status)
+    if input_tokens:
+        metrics.inc("llm_tokens_total", input_tokens, model=model, kind="input")
+    if output_tokens:
+        metrics.inc("llm_tokens_total", output_tokens, model=model, kind="output")
+
+
+# モデルに問い合わせて、応答全体を LLMResult で返す
+# max_tokens / temperature を渡すとモデルの既定値を上書きする
+# Bedrock は推論プロファイルごとの同時実行数の制御を通し、スロットリングされた場合はやり直す
+# （続く場合は他のモデルに切り替える。実際に使ったモデルは結果の model に入る）
+def complete(model, prompt, system_prompt, **params):
+    if MODELS[model]["provider"] != "bedrock":
+        return _complete(model, prompt, system_prompt, params)
+    for attempt in range(BEDROCK_THROTTLE_RETRIES + 1):
+        target = _pick_bedrock_model(model)
+        limiter = get_limiter(target)
+        _acquire_slot(target, limiter)
+        throttled = succeeded = False
+        try:
+            result = _complete(target, prompt, system_prompt, _failover_params(model, target, params))
+            succeeded = True
+            return result
+        except ClientError as e:
+            if not _is_throttle(e):
+                raise
+            throttled = True
+            metrics.inc("llm_throttles_total", model=target)
+            if attempt >= BEDROCK_THROTTLE_RETRIES:
+                raise
+        finally:
+            limiter.release(throttled, succeeded)
+        _throttle_backoff(attempt)
+
+
+def _complete(model, prompt, system_prompt, params):
+    complete_fn, _ = _PROVIDERS[MODELS[model]["provider"]]
+    try:
+        with metrics.timer("llm_seconds", model=model, mode="complete"):
+            result = complete_fn(model, prompt, system_prompt, {**get_generation_params(model), **params})
+    except Exception as e:
+        _record_usage(model, "complete", type(e).__name__)
+        raise
+    _record_usage(model, "complete", "ok", result.input_tokens, result.output_tokens)
+    return result
+
+
+# モデルに問い合わせて、生成されたテキストを少しずつ返す
+# Bedrock のスロットリング時の動きは complete と同じ（やり直し・切り替えは最初のテキストが届く前だけ）
+# 実行枠は最後のテキストを受け取るまで（または呼び出し側が読むのをやめるまで）使う
+# info に dict を渡すと、最後まで受け取った後に "stop_reason" と実際に使ったモデル "model" を入れる
+def stream(model, prompt, system_prompt, info=None, **params):
+    if MODELS[model]["provider"] != "bedrock":
+        yield from _stream(model, prompt, system_prompt, params, info)
+        return
+    for attempt in range(BEDROCK_THROTTLE_RETRIES + 1):
+        target = _pick_bedrock_model(model)
+        limiter = get_limiter(target)
+        _acquire_slot(target, limiter)
+        chunks = _stream(target, prompt, system_prompt, _failover_params(model, target, params), info)
+        started = throttled = succeeded = False
+        try:
+            for text in chunks:
+                started = True
+                yield text
+            succeeded = True
+            return
+        except ClientError as e:
+            if not _is_throttle(e):
+                raise
+            throttled = True
+            metrics.inc("llm_throttles_total", model=target)
+            if started or attempt >= BEDROCK_THROTTLE_RETRIES:
+                raise
+        finally:
+            chunks.close()
+            limiter.release(throttled, succeeded)
+        _throttle_backoff(attempt)
+
+
+def _stream(model, prompt, system_prompt, params, info=None):
+    _, stream_fn = _PROVIDERS[MODELS[model]["provider"]]
+    usage = {}
+    status = "ok"
+    started = time.perf_counter()
+    first = True
+    try:
+        for text in stream_fn(model, prompt, system_prompt, {**get_generation_params(model), **params}, usage):
+            if first:
+                metrics.observe("llm_first_token_seconds", time.perf_counter() - started, model=model)
+                first = False
+            yield text
+    except Exception as e:
+        status = type(e).__name__
+        raise
+    except GeneratorExit:
+        # 呼び出し側が途中で読むのをやめた場合
+        status = "cancelled"
+        raise
+    else:
+        if info is not None:
+            info.update(stop_reason=usage.get("stop_reason", ""), model=model)
+    finally:
+        metrics.observe("llm_seconds", time.perf_counter() - started, model=model, mode="stream")
+        _record_usage(model, "stream", status, usage.get("input_tokens", 0), usage.get("output_tokens", 0))
@@ -0,0 +1,265 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import metrics
+from cache import CACHE_PATH, rollback
+
+# これまでに取得した論文（タイトル・Abstract）のローカル全文検索インデックス（SQLite FTS5 + BM25）
+# - pubmed.py が論文情報を取得するたびに追加するので、使うほど大きくなる
+# - ask_gpt_for_pubmed_query が生成した PubMed の検索式をそのまま使って検索できる
+#   （フィールドタグは無視し、[PDat] などの日付範囲は発表年での絞り込みにする）
+# - 論文情報をまるごと保存しているので、ヒットした論文は NCBI に問い合わせずに表示できる
+LOCAL_INDEX_ENABLED = os.getenv("LOCAL_INDEX_ENABLED", "1") != "0"
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", CACHE_PATH)
+# BM25 でタイトルの一致を Abstract の何倍重視するか
+LOCAL_INDEX_TITLE_WEIGHT = float(os.getenv("LOCAL_INDEX_TITLE_WEIGHT", "2.0"))
+# 最上位のスコア（BM25 の符号を反転した値）に対してこの割合に満たないヒットは返さない
+# （BM25 の値は語の出現頻度で決まり、インデックスが大きくなると変わるので、最上位との比で弱い一致を除く）
+LOCAL_INDEX_MIN_RATIO = float(os.getenv("LOCAL_INDEX_MIN_RATIO", "0.5"))
+# これより低いスコアのヒットも返さない（既定は 0 で使わない。値の意味はインデックスの大きさで変わる）
+LOCAL_INDEX_MIN_SCORE = float(os.getenv("LOCAL_INDEX_MIN_SCORE", "0"))
+
+# 日付範囲として扱うフィールドタグ
+_DATE_TAGS = {"pdat", "dp", "publication date", "date - publication",
+              "edat", "date - entrez", "crdt", "date - create"}
+# PubMed の検索式のトークン（フレーズ・括弧・論理演算子・範囲の ":"・語。空白を含むフィールドタグ付きも含む）
+_TOKEN = re.compile(r'"[^"]*"(?:\[[^\]]*\])?|\(|\)|:|[^\s()":\[]+(?:\[[^\]]*\])?')
+_TAG = re.compile(r"\[([^\]]*)\]$")
+_YEAR = re.compile(r"\d{4}")
+_DATE = re.compile(r"(\d{4})(?:/\d{1,2}){0,2}")
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+# PubMed の検索式を FTS5 の検索式と発表年の範囲に変換する
+# 戻り値: (FTS5 の検索式（語が無ければ空文字）, (開始年, 終了年) または None)
+def to_fts_query(query):
+    tokens = _TOKEN.findall(query)
+    years = []
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def next_token():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
+
+    def term(token):
+        tag = _TAG.search(token)
+        text = token[:tag.start()] if tag else token
+        text = text.strip('"').strip()
+        if tag and tag.group(1).strip().lower() in _DATE_TAGS:
+            match = _YEAR.search(text)
+            if match:
+                years.append(int(match.group()))
+            return None
+        prefix = text.endswith("*")
+        text = text.rstrip("*").replace('"', " ").strip()
+        if not text:
+            return None
+        return f'"{text}"*' if prefix else f'"{text}"'
+
+    def combine(parts, op):
+        parts = [p for p in parts if p]
+        if not parts:
+            return None
+        if len(parts) == 1:
+            return parts[0]
+        return "(" + f" {op} ".join(parts) + ")"
+
+    def parse_or():
+        parts = [parse_and()]
+        while peek() is not None and peek().upper() == "OR":
+            next_token()
+            parts.append(parse_and())
+        return combine(parts, "OR")
+
+    def parse_and():
+        parts = [parse_not()]
+        while peek() is not None and peek() != ")" and peek().upper() != "OR":
+            if peek().upper() == "AND":
+                next_token()
+            parts.append(parse_not())
+        return combine(parts, "AND")
+
+    def parse_not():
+        left = parse_atom()
+        while peek() is not None and peek().upper() == "NOT":
+            next_token()
+            right = parse_atom()
+            if left and right:
+                left = f"({left} NOT {right})"
+        return left
+
+    def parse_atom():
+        token = peek()
+        if token is None:
+            raise QuerySyntaxError(query)
+        next_token()
+        if token == "(":
+            inner = parse_or()
+            if peek() != ")":
+                raise QuerySyntaxError(query)
+            next_token()
+            return inner
+        if token in (")", ":") or token.upper() in ("AND", "OR", "NOT"):
+            raise QuerySyntaxError(query)
+        result = term(token)
+        # "2020"[PDat] : "3000"[PDat] の形の範囲
+        if peek() == ":":
+            next_token()
+            if peek() is None:
+                raise QuerySyntaxError(query)
+            count = len(years)
+            term(next_token())
+            # 2020:2022[dp] の形（タグが範囲全体に付く）では、":" の前の年も日付として扱う
+            start = _DATE.fullmatch(token.strip('"'))
+            if start and len(years) > count:
+                years.append(int(start.group(1)))
+                result = None
+        return result
+
+    try:
+        match = parse_or() if tokens else None
+        if pos != len(tokens):
+            raise QuerySyntaxError(query)
+    except QuerySyntaxError:
+        # 構文を解釈できない場合は、語のいずれかを含むものを探す
+        years.clear()
+        match = combine([term(t) for t in tokens if t not in ("(", ")", ":") and t.upper() not in ("AND", "OR", "NOT")], "OR")
+    year_range = (min(years), max(years)) if years else None
+    return match or "", year_range
+
+
+def _year(pubdate):
+    match = _YEAR.search(pubdate or "")
+    return int(match.group()) if match else None
+
+
+class LocalIndex:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS papers (
+                id INTEGER PRIMARY KEY, pmid TEXT UNIQUE NOT NULL,
+                title TEXT NOT NULL, abstract TEXT NOT NULL, year INTEGER, record TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS papers_year ON papers (year);
+            CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(
+                title, abstract, content='papers', content_rowid='id', tokenize='porter unicode61');
+            CREATE TRIGGER IF NOT EXISTS papers_ai AFTER INSERT ON papers BEGIN
+                INSERT INTO papers_fts (rowid, title, abstract) VALUES (new.id, new.title, new.abstract);
+            END;
+            CREATE TRIGGER IF NOT EXISTS papers_ad AFTER DELETE ON papers BEGIN
+                INSERT INTO papers_fts (papers_fts, rowid, title, abstract) VALUES ('delete', old.id, old.title, old.abstract);
+            END;
+            CREATE TRIGGER IF NOT EXISTS papers_au AFTER UPDATE ON papers BEGIN
+                INSERT INTO papers_fts (papers_fts, rowid, title, abstract) VALUES ('delete', old.id, old.title, old.abstract);
+                INSERT INTO papers_fts (rowid, title, abstract) VALUES (new.id, new.title, new.abstract);
+            END;
+        """)
+
+    # 論文情報（pubmed.py の dict）を追加する
+    # replace=False なら登録済みの PMID は書き換えない（キャッシュから読んだ論文の登録漏れを埋める用途）
+    def add(self, records, replace=True):
+        rows = [
+            (r["pmid"], r.get("title", ""), r.get("abstract", ""), _year(r.get("pubdate")), json.dumps(r, ensure_ascii=False))
+            for r in records if r.get("pmid")
+        ]
+        if not rows:
+            return
+        if replace:
+            sql = ("INSERT INTO papers (pmid, title, abstract, year, record) VALUES (?, ?, ?, ?, ?) "
+                   "ON CONFLICT(pmid) DO UPDATE SET title = excluded.title, abstract = excluded.abstract, "
+                   "year = excluded.year, record = excluded.record")
+        else:
+            sql = "INSERT OR IGNORE INTO papers (pmid, title, abstract, year, record) VALUES (?, ?, ?, ?, ?)"
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(sql, rows)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                rollback(self._conn)
+                raise
+
+    # PubMed の検索式で検索し、スコアの高い順に論文情報を返す（各 dict に "score" を付ける）
+    def search(self, query, limit=3, min_score=LOCAL_INDEX_MIN_SCORE):
+        match, years = to_fts_query(query)
+        if not match:
+            return []
+        sql = ("SELECT p.record, -bm25(papers_fts, ?, 1.0) AS score FROM papers_fts "
+               "JOIN papers p ON p.id = papers_fts.rowid WHERE papers_fts MATCH ?")
+        params = [LOCAL_INDEX_TITLE_WEIGHT, match]
+        if years:
+            sql += " AND p.year BETWEEN ? AND ?"
+            params += list(years)
+        sql += " ORDER BY score DESC LIMIT ?"
+        params.append(limit)
+        with metrics.stage("local_search"), self._lock:
+            try:
+                rows = self._conn.execute(sql, params).fetchall()
+            except sqlite3.OperationalError:
+                return []
+        if rows:
+            min_score = max(min_score, rows[0][1] * LOCAL_INDEX_MIN_RATIO)
+        results = []
+        for record, score in rows:
+            if score < min_score:
+                continue
+            record = json.loads(record)
+            record["score"] = score
+            results.append(record)
+        return results
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM papers").fetchone()[0]
+
+
+_index = None
+_index_lock = threading.Lock()
+_index_failed = False
+
+
+# プロセス全体で共有するインデックス（無効な場合や FTS5 が使えない場合は None）
+def get_local_index():
+    global _index, _index_failed
+    if not LOCAL_INDEX_ENABLED:
+        return None
+    with _index_lock:
+        if _index is None and not _index_failed:
+            try:
+                _index = LocalIndex(LOCAL_INDEX_PATH)
+            except sqlite3.OperationalError as e:
+                _index_failed = True
+                print(f"[WARN] ローカル検索インデックスを使えません（SQLite の FTS5 が必要です）: {e}")
+        return _index
+
+
+# 論文情報をインデックスに追加する（失敗しても呼び出し側の処理は続ける）
+def add_records(records, replace=True):
+    index = get_local_index()
+    if index is None:
+        return
+    try:
+        index.add(records, replace)
+    except sqlite3.Error as e:
+        print(f"[WARN] ローカル検索インデックスに追加できませんでした: {e}")
+
+
+# ローカルのインデックスを検索する（使えない場合は空のリスト）
+def search(query, limit=3):
+    index = get_local_index()
+    if index is None:
+        return []
+    return index.search(query, limit)
@@ -0,0 +1,322 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 処理時間・トークン数・キャッシュヒット率・リトライ回数の計測
+# プロセス内の全セッション・全スレッドで1つの集計を共有し、Prometheus のテキスト形式で出力する
+# - METRICS_PORT を指定すると http://<host>:<port>/metrics で公開する
+# - METRICS_FILE を指定すると METRICS_FILE_INTERVAL 秒ごとにファイルへ書き出す（node_exporter の textfile collector 向け）
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_FILE_INTERVAL = float(os.getenv("METRICS_FILE_INTERVAL", "15"))
+METRICS_PREFIX = "pubmed_ai_"
+
+# 段階ごとの目標処理時間（秒）。"total=10,summary=8" の形式で指定する
+# 超えた回数を slo_violations_total に数える
+METRICS_SLO = os.getenv("METRICS_SLO", "total=10")
+
+# ヒストグラムのバケット（秒）
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+# 診断パネルでパーセンタイルを出すために残しておく直近の計測値の数
+RECENT_SAMPLES = int(os.getenv("METRICS_RECENT_SAMPLES", "1000"))
+
+# 各メトリクスの説明（Prometheus の HELP 行）
+DESCRIPTIONS = {
+    "stage_seconds": "パイプラインの段階ごとの処理時間",
+    "stage_errors_total": "段階ごとの例外の数",
+    "slo_violations_total": "目標処理時間を超えた回数",
+    "ncbi_seconds": "E-utilities 呼び出し1回あたりの処理時間（レート制限の待ちとリトライを含む）",
+    "llm_seconds": "LLM 呼び出し1回あたりの処理時間",
+    "llm_first_token_seconds": "ストリーミングで最初のテキストが届くまでの時間",
+    "llm_requests_total": "LLM の呼び出し回数",
+    "llm_tokens_total": "LLM の入力・出力トークン数",
+    "llm_retries_total": "Bedrock クライアント内部のリトライ回数",
+    "llm_throttles_total": "Bedrock のスロットリング・一時的な障害の回数（botocore のリトライ後）",
+    "llm_failovers_total": "スロットリングが続いたため他のモデルの推論プロファイルに切り替えた回数",
+    "llm_slot_wait_seconds": "推論プロファイルごとの同時実行数の上限で待った時間",
+    "router_decisions_total": "「自動」モードでタスクごとに選ばれたモデルの回数",
+    "router_truncated_total": "max_tokens で出力が打ち切られた回数",
+    "cache_requests_total": "キャッシュの参照回数（ヒット・ミス別）",
+    "http_requests_total": "HTTP リクエストの試行回数（ステータス別）",
+    "http_retries_total": "HTTP リクエストのリトライ回数",
+    "singleflight_total": "同時実行をまとめた処理の呼び出し回数（実行した側 leader・結果を受け取った側 shared 別）",
+    "jobs_total": "バックグラウンドのジョブの数（登録・完了・失敗別）",
+    "job_wait_seconds": "ジョブが登録されてから実行が始まるまでの待ち時間",
+    "job_seconds": "ジョブが登録されてから完了するまでの時間",
+    "query_candidates_total": "検索式の候補ごとの esearch の結果（候補の順位 rank・ヒットあり hit・なし empty・失敗 error 別）",
+    "singleflight_timeouts_total": "同時実行中の他の呼び出しの結果を待ちきれなかった回数",
+}
+
+
+def _parse_slo(text):
+    slo = {}
+    for item in text.split(","):
+        name, _, seconds = item.partition("=")
+        if name.strip() and seconds.strip():
+            slo[name.strip()] = float(seconds)
+    return slo
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+# カウンターとヒストグラムの集計（スレッドセーフ）
+class Metrics:
+    def __init__(self, slo=None):
+        self.slo = dict(slo or {})
+        self._counters = {}  # (名前, ラベル) -> 値
+        self._histograms = {}  # (名前, ラベル) -> [バケットごとの数, 合計, 件数]
+        self._recent = {}  # (名前, ラベル) -> 直近の計測値
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+                self._recent[key] = deque(maxlen=RECENT_SAMPLES)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            self._recent[key].append(seconds)
+
+    # 段階の処理時間を記録し、目標を超えていれば違反として数える
+    def observe_stage(self, stage, seconds):
+        self.observe("stage_seconds", seconds, stage=stage)
+        if stage in self.slo and seconds > self.slo[stage]:
+            self.inc("slo_violations_total", stage=stage)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    # with metrics.stage("esearch"): ... の形で段階の処理時間を計測する
+    @contextmanager
+    def stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.inc("stage_errors_total", stage=stage, error=type(e).__name__)
+            raise
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started)
+
+    # ヒストグラムの直近の計測値（labels を含むラベルの系列をすべてまとめる）
+    def samples(self, name, **labels):
+        wanted = set(labels.items())
+        with self._lock:
+            return [v for (n, key), values in self._recent.items() if n == name and wanted <= set(key) for v in values]
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._recent.clear()
+
+    # Prometheus のテキスト形式
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self._histograms.items())
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append(f"# HELP {METRICS_PREFIX}{name} {DESCRIPTIONS[name]}")
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{METRICS_PREFIX}{name}{_labels_text(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            declare(name, "histogram")
+            for bound, n in zip(BUCKETS, buckets):
+                lines.append(f"{METRICS_PREFIX}{name}_bucket{_labels_text(labels + (('le', bound),))} {n}")
+            lines.append(f"{METRICS_PREFIX}{name}_bucket{_labels_text(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{METRICS_PREFIX}{name}_sum{_labels_text(labels)} {total}")
+            lines.append(f"{METRICS_PREFIX}{name}_count{_labels_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    # 診断パネル向けの集計
+    # - stages: 段階ごとの件数・p50・p95・目標・違反数
+    # - llm: モデルごとの呼び出し回数・トークン数・リトライ回数
+    # - caches: キャッシュごとのヒット率
+    # - http: エンドポイントごとのリトライ回数
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            recent = {key: list(values) for key, values in self._recent.items()}
+
+        def counter(name, **labels):
+            return counters.get((name, tuple(sorted(labels.items()))), 0)
+
+        def label_values(name, label):
+            return sorted({dict(labels)[label] for (n, labels) in counters if n == name and label in dict(labels)})
+
+        stages = []
+        for (name, labels), values in sorted(recent.items()):
+            if name != "stage_seconds":
+                continue
+            stage = dict(labels)["stage"]
+            stages.append({
+                "stage": stage,
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "slo": self.slo.get(stage),
+                "violations": counter("slo_violations_total", stage=stage),
+            })
+
+        llm = []
+        for model in label_values("llm_requests_total", "model"):
+            requests = sum(v for (n, labels), v in counters.items()
+                           if n == "llm_requests_total" and dict(labels).get("model") == model)
+            llm.append({
+                "model": model,
+                "requests": requests,
+                "input_tokens": counter("llm_tokens_total", model=model, kind="input"),
+                "output_tokens": counter("llm_tokens_total", model=model, kind="output"),
+                "retries": counter("llm_retries_total", model=model),
+            })
+
+        caches = []
+        for cache in label_values("cache_requests_total", "cache"):
+            hits = counter("cache_requests_total", cache=cache, result="hit")
+            misses = counter("cache_requests_total", cache=cache, result="miss")
+            caches.append({"cache": cache, "hits": hits, "misses": misses,
+                           "hit_rate": hits / (hits + misses) if hits + misses else 0.0})
+
+        http = []
+        for endpoint in label_values("http_requests_total", "endpoint"):
+            http.append({
+                "endpoint": endpoint,
+                "requests": sum(v for (n, labels), v in counters.items()
+                                if n == "http_requests_total" and dict(labels).get("endpoint") == endpoint),
+                "retries": sum(v for (n, labels), v in counters.items()
+                               if n == "http_retries_total" and dict(labels).get("endpoint") == endpoint),
+            })
+        return {"stages": stages, "llm": llm, "caches": caches, "http": http}
+
+
+_metrics = Metrics(_parse_slo(METRICS_SLO))
+
+
+# プロセス全体で共有する集計
+def get_metrics():
+    return _metrics
+
+
+def inc(name, value=1, **labels):
+    _metrics.inc(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    _metrics.observe(name, seconds, **labels)
+
+
+def observe_stage(stage, seconds):
+    _metrics.observe_stage(stage, seconds)
+
+
+def timer(name, **labels):
+    return _metrics.timer(name, **labels)
+
+
+def stage(name):
+    return _metrics.stage(name)
+
+
+# キャッシュのヒット・ミスをまとめて数える
+def record_cache(cache, hits, misses):
+    if hits:
+        _metrics.inc("cache_requests_total", hits, cache=cache, result="hit")
+    if misses:
+        _metrics.inc("cache_requests_total", misses, cache=cache, result="miss")
+
+
+# 一時ファイルに書いてから置き換える（読み手が書きかけのファイルを見ないように）
+def write_file(path=None):
+    path = path or METRICS_FILE
+    if not path:
+        return
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(_metrics.render())
+    os.replace(tmp, path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = _metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+def _write_file_forever():
+    while True:
+        time.sleep(METRICS_FILE_INTERVAL)
+        try:
+            write_file()
+        except OSError as e:
+            print(f"[WARN] メトリクスファイルを書き出せませんでした: {e}")
+
+
+# METRICS_PORT / METRICS_FILE の設定に応じて出力を開始する（プロセス内で1回だけ）
+def start_exporters():
+    global _exporters_started
+    with _exporters_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+        if METRICS_PORT:
+            server = ThreadingHTTPServer(("0.0.0.0", METRICS_PORT), _Handler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        if METRICS_FILE:
+            threading.Thread(target=_write_file_forever, name="metrics-file", daemon=True).start()
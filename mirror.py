@@ -0,0 +1,303 @@
+import argparse
+import glob
+import gzip
+import json
+import mmap
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import metrics
+from cache import rollback
+from local_index import to_fts_query
+from pubmed_xml import parse_pubmed_xml
+
+# PubMed の baseline / update ファイル（https://ftp.ncbi.nlm.nih.gov/pubmed/）のローカルミラー
+# - ローカルのディスクにある XML（.xml.gz / .xml）を読み込み、1つの SQLite ファイルにまとめる
+#   （論文情報は zlib で圧縮した JSON、PMID・発表年のインデックスと、タイトル・Abstract・MeSH の全文検索インデックス）
+# - PUBMED_BACKEND=local のとき、pubmed.py の検索と論文情報の取得はまずここを引き、無ければ E-utilities に問い合わせる
+#
+#   python mirror.py /data/pubmed/baseline /data/pubmed/updatefiles --workers 8
+#
+# - ファイルはプロセスごとに並列に解析し、書き込みはファイル名の順に1つずつ行う（update の上書き・削除の順序を保つ）
+# - 取り込み済みのファイル（名前と大きさが同じもの）は飛ばすので、update ファイルが増えたら同じコマンドを再実行すればよい
+PUBMED_MIRROR_PATH = os.getenv("PUBMED_MIRROR_PATH", "pubmed_mirror.sqlite3")
+# 読み取りに使うメモリマップの大きさ（バイト。0 なら使わない）
+PUBMED_MIRROR_MMAP_SIZE = int(os.getenv("PUBMED_MIRROR_MMAP_SIZE", str(1 << 30)))
+# BM25 でタイトルの一致を Abstract の何倍重視するか（MeSH は Abstract の半分）
+PUBMED_MIRROR_TITLE_WEIGHT = float(os.getenv("PUBMED_MIRROR_TITLE_WEIGHT", "2.0"))
+# ヒット件数を数える上限（それ以上は数えずにこの値を返す）
+PUBMED_MIRROR_COUNT_LIMIT = int(os.getenv("PUBMED_MIRROR_COUNT_LIMIT", "10000"))
+# 最後の取り込みからこの日数を過ぎたら、最近の論文はミラーに揃っていないとみなす（update ファイルは毎日公開される）
+PUBMED_MIRROR_MAX_AGE = float(os.getenv("PUBMED_MIRROR_MAX_AGE", "7"))
+
+_YEAR = re.compile(r"\d{4}")
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS articles (pmid INTEGER PRIMARY KEY, year INTEGER, record BLOB NOT NULL);
+    CREATE INDEX IF NOT EXISTS articles_year ON articles (year);
+    CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING fts5(
+        title, abstract, mesh, content='', tokenize='porter unicode61');
+    CREATE TABLE IF NOT EXISTS files (
+        name TEXT PRIMARY KEY, size INTEGER NOT NULL, articles INTEGER NOT NULL, deleted INTEGER NOT NULL,
+        ingested_at REAL NOT NULL);
+"""
+
+
+def _year(pubdate):
+    match = _YEAR.search(pubdate or "")
+    return int(match.group()) if match else None
+
+
+# 全文検索インデックスに入れる列（タイトル・Abstract・MeSH 用語）
+def _fts_columns(record):
+    return record.get("title", ""), record.get("abstract", ""), " ; ".join(record.get("mesh_terms", []))
+
+
+# ---------------------------------------------------------------------------
+# 取り込み
+
+
+# XML ファイルを開く（.gz は少しずつ展開しながら読み、展開済みのファイルはメモリマップで読む）
+def _open_xml(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# 1ファイルを解析して、書き込む行と削除する PMID を返す（ワーカープロセスで実行する）
+def _parse_file(path):
+    # 空のファイル（ダウンロード途中で止まったものなど）は解析できないので、0 件として扱う
+    if os.path.getsize(path) == 0:
+        return path, [], []
+    rows = []
+    deleted = []
+    source = _open_xml(path)
+    try:
+        for record in parse_pubmed_xml(source, deleted):
+            if not record["pmid"]:
+                continue
+            payload = zlib.compress(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+            rows.append((int(record["pmid"]), _year(record["pubdate"]), payload, *_fts_columns(record)))
+    finally:
+        source.close()
+    deleted = {int(p) for p in deleted if p}
+    # 同じファイルに同じ PMID が複数ある場合は後のものを、削除された PMID は除く
+    rows = {row[0]: row for row in rows if row[0] not in deleted}
+    return path, list(rows.values()), sorted(deleted)
+
+
+class PubMedMirror:
+    def __init__(self, path=PUBMED_MIRROR_PATH, readonly=True):
+        self.path = path
+        self._lock = threading.Lock()
+        if readonly:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            if PUBMED_MIRROR_MMAP_SIZE > 0:
+                self._conn.execute(f"PRAGMA mmap_size={PUBMED_MIRROR_MMAP_SIZE}")
+        else:
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA cache_size=-262144")  # 256MB
+            self._conn.executescript(_SCHEMA)
+
+    # 取り込み済みのファイル {名前: 大きさ}
+    def ingested_files(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT name, size FROM files").fetchall())
+
+    # 1ファイル分の解析結果を書き込む（既にある PMID は新しい版で置き換える）
+    # 失敗した場合はそのファイルの書き込みをすべて取り消す（次のファイルの取り込みは続けられる）
+    def write_file(self, path, rows, deleted):
+        pmids = [row[0] for row in rows] + deleted
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                # 全文検索インデックスは本文を持たないので、置き換え・削除する論文の古い列を渡して取り除く
+                for i in range(0, len(pmids), 500):
+                    chunk = pmids[i:i + 500]
+                    marks = ",".join("?" * len(chunk))
+                    old = self._conn.execute(f"SELECT pmid, record FROM articles WHERE pmid IN ({marks})",
+                                             chunk).fetchall()
+                    self._conn.executemany(
+                        "INSERT INTO articles_fts (articles_fts, rowid, title, abstract, mesh) VALUES ('delete', ?, ?, ?, ?)",
+                        [(pmid, *_fts_columns(json.loads(zlib.decompress(record)))) for pmid, record in old])
+                if deleted:
+                    self._conn.executemany("DELETE FROM articles WHERE pmid = ?", [(p,) for p in deleted])
+                self._conn.executemany("INSERT OR REPLACE INTO articles (pmid, year, record) VALUES (?, ?, ?)",
+                                       [row[:3] for row in rows])
+                self._conn.executemany("INSERT INTO articles_fts (rowid, title, abstract, mesh) VALUES (?, ?, ?, ?)",
+                                       [(row[0], *row[3:]) for row in rows])
+                self._conn.execute("INSERT OR REPLACE INTO files (name, size, articles, deleted, ingested_at) "
+                                   "VALUES (?, ?, ?, ?, ?)",
+                                   (os.path.basename(path), os.path.getsize(path), len(rows), len(deleted), time.time()))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                rollback(self._conn)
+                raise
+
+    # PMID で論文情報をまとめて引く（見つからないものは含まない）
+    def get_many(self, pmids):
+        pmids = [int(p) for p in pmids]
+        records = {}
+        with self._lock:
+            for i in range(0, len(pmids), 500):
+                chunk = pmids[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                for pmid, record in self._conn.execute(
+                        f"SELECT pmid, record FROM articles WHERE pmid IN ({marks})", chunk):
+                    records[str(pmid)] = json.loads(zlib.decompress(record))
+        return records
+
+    def _match(self, query):
+        match, years = to_fts_query(query)
+        if not match:
+            return None, []
+        sql = "FROM articles_fts JOIN articles a ON a.pmid = articles_fts.rowid WHERE articles_fts MATCH ?"
+        params = [match]
+        if years:
+            sql += " AND a.year BETWEEN ? AND ?"
+            params += list(years)
+        return sql, params
+
+    # PubMed の検索式で検索し、関連度の高い順に PMID を返す（offset 件目から limit 件）
+    def search(self, query, limit=20, offset=0):
+        where, params = self._match(query)
+        if where is None:
+            return []
+        sql = f"SELECT a.pmid {where} ORDER BY bm25(articles_fts, ?, 1.0, 0.5) LIMIT ? OFFSET ?"
+        with metrics.stage("mirror_search"), self._lock:
+            try:
+                rows = self._conn.execute(sql, params + [PUBMED_MIRROR_TITLE_WEIGHT, limit, offset]).fetchall()
+            except sqlite3.OperationalError:
+                return []
+        return [str(pmid) for pmid, in rows]
+
+    # ヒット件数（PUBMED_MIRROR_COUNT_LIMIT を上限に数える）
+    def count(self, query):
+        where, params = self._match(query)
+        if where is None:
+            return 0
+        with self._lock:
+            try:
+                return self._conn.execute(f"SELECT COUNT(*) FROM (SELECT a.pmid {where} LIMIT ?)",
+                                          params + [PUBMED_MIRROR_COUNT_LIMIT]).fetchone()[0]
+            except sqlite3.OperationalError:
+                return 0
+
+    # 検索式の期間の論文をミラーが網羅しているか
+    # 最後の取り込みから PUBMED_MIRROR_MAX_AGE 日を過ぎている場合は、期間の終わりが最後の取り込みの年以降
+    # （期間の指定が無い場合を含む）の検索を網羅していないとみなす
+    def covers(self, query):
+        with self._lock:
+            updated_at = self._conn.execute("SELECT MAX(ingested_at) FROM files").fetchone()[0]
+        if updated_at is None:
+            return False
+        if time.time() - updated_at <= PUBMED_MIRROR_MAX_AGE * 86400:
+            return True
+        _, years = to_fts_query(query)
+        return years is not None and years[1] < time.gmtime(updated_at).tm_year
+
+    # 読み取れる状態か確かめる（ファイルが無い・取り込み前などの場合は sqlite3.Error を送出する）
+    def probe(self):
+        with self._lock:
+            self._conn.execute("SELECT pmid FROM articles LIMIT 1").fetchall()
+
+    def close(self):
+        self._conn.close()
+
+
+# baseline / update ファイルを取り込む（ファイル名の順に書き込み、取り込み済みのファイルは飛ばす）
+# 解析は workers 個のプロセスで並列に行い、解析済みで書き込み待ちのファイルは workers の2倍までにする
+def ingest(paths, path=PUBMED_MIRROR_PATH, workers=None, log=sys.stderr):
+    mirror = PubMedMirror(path, readonly=False)
+    done = mirror.ingested_files()
+    paths = sorted((p for p in paths if done.get(os.path.basename(p)) != os.path.getsize(p)), key=os.path.basename)
+    skipped = len(done)
+    total_rows = total_deleted = failed = 0
+    started = time.monotonic()
+    workers = workers or os.cpu_count() or 1
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            queued = iter(paths)
+            for p in queued:
+                pending.append((p, executor.submit(_parse_file, p)))
+                if len(pending) >= workers * 2:
+                    break
+            while pending:
+                file_path, future = pending.popleft()
+                next_path = next(queued, None)
+                if next_path is not None:
+                    pending.append((next_path, executor.submit(_parse_file, next_path)))
+                # 解析・書き込みに失敗したファイルは飛ばす（取り込み済みとして記録しないので、次回の実行でやり直す）
+                try:
+                    _, rows, deleted = future.result()
+                    mirror.write_file(file_path, rows, deleted)
+                except (sqlite3.Error, ET.ParseError, OSError, EOFError) as e:
+                    failed += 1
+                    print(f"[WARN] {os.path.basename(file_path)} を取り込めませんでした: {e}", file=log)
+                    continue
+                total_rows += len(rows)
+                total_deleted += len(deleted)
+                print(f"[INFO] {os.path.basename(file_path)}: {len(rows)} 件を取り込み、{len(deleted)} 件を削除しました"
+                      f"（{time.monotonic() - started:.0f} 秒）", file=log)
+    finally:
+        mirror.close()
+    print(f"[INFO] 完了: {len(paths)} ファイル（取り込み済み {skipped} ファイル・失敗 {failed} ファイル）/ "
+          f"{total_rows} 件 / 削除 {total_deleted} 件", file=log)
+    return total_rows
+
+
+# ---------------------------------------------------------------------------
+# 読み取り
+
+_mirror = None
+_mirror_lock = threading.Lock()
+_mirror_failed = False
+
+
+# プロセス全体で共有するミラー（ファイルが無い場合は警告を1回出して None）
+def get_mirror():
+    global _mirror, _mirror_failed
+    with _mirror_lock:
+        if _mirror is None and not _mirror_failed:
+            try:
+                _mirror = PubMedMirror(PUBMED_MIRROR_PATH)
+                _mirror.probe()
+            except sqlite3.Error as e:
+                _mirror_failed = True
+                _mirror = None
+                print(f"[WARN] PubMed のローカルミラー（{PUBMED_MIRROR_PATH}）を使えません: {e}")
+        return _mirror
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PubMed の baseline / update ファイルをローカルミラーに取り込みます")
+    parser.add_argument("inputs", nargs="+", help="XML ファイル（.xml.gz / .xml）またはそれを含むディレクトリ")
+    parser.add_argument("--path", default=PUBMED_MIRROR_PATH, help="ミラーの SQLite ファイル")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="解析に使うプロセスの数")
+    args = parser.parse_args(argv)
+
+    paths = []
+    for item in args.inputs:
+        if os.path.isdir(item):
+            paths += glob.glob(os.path.join(item, "*.xml.gz")) + glob.glob(os.path.join(item, "*.xml"))
+        else:
+            paths.append(item)
+    if not paths:
+        parser.error("取り込む XML ファイルがありません")
+    ingest(paths, args.path, args.workers)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,551 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import llm
+import local_index
+import metrics
+import rerank
+import router
+import singleflight
+from pubmed import search_pubmed_history, fetch_pubmed_metadata_batch, fetch_pubmed_page
+from pubmed_xml import format_sections
+from query_cache import get_query_cache, normalize_question
+from cache import get_summary_cache, prompt_version, summary_cache_key, purge_stale_summaries
+
+# PubMed検索 → Claude 要約のパイプライン（Streamlit に依存しない部分）
+# aws2.py の画面・batch.py のバッチ処理・負荷試験（bench）から使う
+
+# 要約に失敗したときに表示する文言
+SUMMARY_FAILED = "要約に失敗しました。"
+
+# 一括要約モードの予算（入力トークンの上限と、1件あたりに見込む出力トークン数）
+BATCH_SUMMARY_INPUT_BUDGET = int(os.getenv("BATCH_SUMMARY_INPUT_BUDGET", "60000"))
+BATCH_SUMMARY_OUTPUT_PER_PAPER = int(os.getenv("BATCH_SUMMARY_OUTPUT_PER_PAPER", "1200"))
+
+# 要約する論文を選ぶために取得する候補の数（ローカルで並べ替えて上位だけを要約する。0 なら PubMed の順のまま）
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "50"))
+
+# 要約に渡す Abstract の1件あたりの入力トークンの上限（0 なら制限しない）
+# 超える場合は優先度の高いセクションから残し、収まらないセクションは文の区切りで切り詰める
+ABSTRACT_TOKEN_BUDGET = int(os.getenv("ABSTRACT_TOKEN_BUDGET", "0"))
+# セクションの優先度（先頭ほど優先。どれにも当てはまらないセクションは最後）
+SECTION_PRIORITY = ("CONCLUSIONS", "RESULTS", "OBJECTIVE", "METHODS", "BACKGROUND")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+# 1回のクエリ生成で作る検索式の候補の数（条件の厳しいものから緩いものの順。1 なら従来どおり1つだけ）
+QUERY_CANDIDATES = max(1, int(os.getenv("QUERY_CANDIDATES", "3")))
+# 候補の esearch を同時に実行するスレッドの数（NCBI のレート制限は pubmed.py で全体に掛かる）
+QUERY_FANOUT_WORKERS = int(os.getenv("QUERY_FANOUT_WORKERS", "8"))
+# 候補の行頭に付いた番号や記号（「1. 」「- 」など）
+_CANDIDATE_PREFIX = re.compile(r"^\s*(?:\d+[.)、]|[-*・])\s*")
+
+# PubMed検索クエリ生成用のシステムプロンプト
+QUERY_SYSTEM_PROMPT = f"""
+あなたはPubMedの検索クエリを作成する専門家です。
+日本語の医学的な質問に対して、PubMedで検索するための英語の検索クエリを作成してください。
+検索クエリが作成できない場合は、空文字を返してください。
+
+【ルール】
+1. 回答は検索キーワード（検索式）のみで返してください。説明は不要です。
+2. クエリはPubMedの検索構文に従い、論理演算子（AND, OR）を使用してください。
+3. 基本形式: (疾患名 OR 同義語) AND (目的) AND (対象) AND ("2020"[PDat] : "3000"[PDat])
+4. 検索式は条件の厳しいものから緩いものの順に最大{QUERY_CANDIDATES}個作成し、1行に1つずつ書いてください。
+   後の検索式ほど、重要度の低い条件（対象・目的・期間など）を外して広く検索できるようにしてください。
+"""
+
+# 要約用のシステムプロンプト
+SUMMARY_SYSTEM_PROMPT = "PubMedから取得したAbstractです。日本語で、情報量を落とさずに箇条書きで、要約してください。箇条書きは、読みやすくするためひとつずつ改行してください。"
+
+# 一括要約用のシステムプロンプト（PMID ごとの JSON で返してもらう）
+BATCH_SUMMARY_SYSTEM_PROMPT = SUMMARY_SYSTEM_PROMPT + """
+複数のAbstractが「--- PMID: 番号 ---」で区切られて渡されます。Abstractごとに要約し、次の形式のJSONだけを返してください。説明は不要です。
+{"summaries": [{"pmid": "番号", "summary": "要約"}]}
+"""
+
+
+# PubMed検索クエリ生成（検索式の候補を1行に1つずつ並べた文字列を返す。split_queries で分ける）
+# 同じ質問（正規化した文字列が同じもの）のクエリ生成が実行中なら、その結果を待って使う
+def ask_gpt_for_pubmed_query(user_input, model):
+    # 似た質問に対して生成済みのクエリがあれば、それを使う
+    query_cache = get_query_cache()
+    cached = query_cache.get(user_input, model)
+    metrics.record_cache("query", cached is not None, cached is None)
+    if cached is not None:
+        return cached
+    return singleflight.do("query", (model, normalize_question(user_input)),
+                           lambda: _generate_query(user_input, model))
+
+
+def _generate_query(user_input, model):
+    with metrics.stage("query"):
+        result = router.complete("query", model, user_input, QUERY_SYSTEM_PROMPT, units=QUERY_CANDIDATES)
+    query = result.text
+    # max_tokens で打ち切られた場合、最後の候補は途中までしか無いので捨てる
+    if result.stop_reason in llm.TRUNCATED_STOP_REASONS and len(split_queries(query)) > 1:
+        query = "\n".join(split_queries(query)[:-1])
+    if not is_empty_query(query):
+        get_query_cache().put(user_input, query, model)
+    return query
+
+
+# 生成されたクエリを検索式の候補のリストに分ける（厳しいものから緩いものの順、重複と空の候補は除く）
+def split_queries(query):
+    queries = []
+    for line in (query or "").splitlines():
+        line = _CANDIDATE_PREFIX.sub("", line).strip().strip("`").strip()
+        if line and line != '""' and line not in queries:
+            queries.append(line)
+    return queries[:QUERY_CANDIDATES]
+
+
+# 生成されたクエリが空（検索クエリを作れなかった）かどうか
+def is_empty_query(query):
+    return not split_queries(query)
+
+
+_fanout_executor = None
+_fanout_lock = threading.Lock()
+
+
+# 検索式の候補の esearch に使うスレッドプール（プロセス全体で共有する）
+def get_fanout_executor():
+    global _fanout_executor
+    with _fanout_lock:
+        if _fanout_executor is None:
+            _fanout_executor = ThreadPoolExecutor(max_workers=QUERY_FANOUT_WORKERS, thread_name_prefix="fanout")
+        return _fanout_executor
+
+
+# 検索式の候補をすべて同時に esearch し、候補の順に結果を返す（失敗した候補は例外を返す）
+def _search_candidates(queries, max_results):
+    if len(queries) == 1:
+        return [search_pubmed_history(queries[0], max_results=max_results)]
+    futures = [get_fanout_executor().submit(search_pubmed_history, q, max_results=max_results) for q in queries]
+    results = []
+    for rank, future in enumerate(futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"[WARN] 検索式の候補 {rank + 1} の検索に失敗しました: {e}")
+            metrics.inc("query_candidates_total", rank=str(rank), result="error")
+            results.append(e)
+            continue
+        metrics.inc("query_candidates_total", rank=str(rank), result="hit" if result["pmids"] else "empty")
+        results.append(result)
+    return results
+
+
+# PubMed を検索して表示する論文を決める
+# query に検索式の候補が複数ある場合は、すべてを同時に esearch し、ヒットした最も厳しい候補の結果を使う
+# その候補だけでは top_k 件に満たなければ、緩い候補のヒットを順に加える（重複する PMID は除く）
+# 戻り値の検索の状態（ヒット総数と「さらに論文を表示」の履歴）は最後にヒットを加えた候補のもの
+# （緩い候補は厳しい候補の条件を外したものなので、そのヒットは厳しい候補のヒットをほぼ含む）
+# RERANK_CANDIDATES 件の候補の論文情報をまとめて取得し、ローカルで並べ替えた上位 top_k 件を返す
+# 戻り値: (search_pubmed_history の結果, 表示する論文, 並べ替えで後回しにした論文の PMID)
+def search_papers(query, top_k):
+    with metrics.stage("search"):
+        return _search_papers(query, top_k)
+
+
+def _search_papers(query, top_k):
+    max_results = max(top_k, RERANK_CANDIDATES)
+    results = _search_candidates(split_queries(query) or [query.strip()], max_results)
+    searches = [r for r in results if not isinstance(r, Exception)]
+    if not searches:
+        raise results[0]
+    hits = [r for r in searches if r["pmids"]]
+    if not hits:
+        return searches[0], [], []
+    search = hits[0]
+    pmids = list(search["pmids"])
+    for relaxed in hits[1:]:
+        if len(pmids) >= top_k:
+            break
+        pmids = list(dict.fromkeys(pmids + relaxed["pmids"]))
+        search = relaxed
+    papers = fetch_pubmed_metadata_batch(pmids)
+    if RERANK_CANDIDATES > top_k:
+        with metrics.stage("rerank"):
+            papers = rerank.rerank(hits[0]["query"], papers)
+    return search, papers[:top_k], [data["pmid"] for data in papers[top_k:]]
+
+
+# 要約のキャッシュのバージョンに使う生成パラメータ
+# max_tokens は router.py が呼び出しごとに決めるので、送った値ではなく決め方の設定を使う
+# Abstract の切り詰め（compact_abstract）の上限が変わると要約の入力が変わるので、それも含める
+def _summary_params(model, batch=False):
+    task = "batch_summary" if batch else "summary"
+    return {**llm.get_generation_params(model), "max_tokens": router.budget_policy(task, model),
+            "abstract_token_budget": ABSTRACT_TOKEN_BUDGET}
+
+
+# 要約キャッシュのキー（PMID × モデル × プロンプトと生成パラメータのハッシュ）
+# 一括要約モードの結果はプロンプトが異なるので別のキーで保存する
+def get_summary_cache_key(pmid, model, batch=False):
+    system_prompt = BATCH_SUMMARY_SYSTEM_PROMPT if batch else SUMMARY_SYSTEM_PROMPT
+    version = prompt_version(system_prompt, _summary_params(model, batch))
+    return summary_cache_key(pmid, model, version)
+
+
+# 保存済みの要約をまとめて読み込み、{pmid: 要約} を返す（どちらのモードの要約でもよい）
+# 「自動」モードでは、要約に使われうるどのモデルの要約でもよい
+def get_cached_summaries(pmids, model):
+    if model == router.AUTO_MODEL:
+        models = list(dict.fromkeys(router.ROUTES["batch_summary"] + router.ROUTES["summary"]))
+    else:
+        models = [model]
+    keys = {get_summary_cache_key(pmid, m, batch): pmid for m in models for pmid in pmids for batch in (True, False)}
+    hits = get_summary_cache().get_many(keys)
+    # 1件ずつ要約した結果を優先する（辞書の後勝ち）
+    summaries = {keys[key]: hits[key] for key in keys if key in hits}
+    metrics.record_cache("summary", len(summaries), len(set(pmids)) - len(summaries))
+    return summaries
+
+
+# 現在のプロンプト以外のバージョンの要約を削除する
+def purge_old_summaries(models):
+    purge_stale_summaries([
+        prompt_version(system_prompt, _summary_params(m, batch))
+        for m in models if m in llm.MODELS
+        for system_prompt, batch in ((SUMMARY_SYSTEM_PROMPT, False), (BATCH_SUMMARY_SYSTEM_PROMPT, True))
+    ])
+
+
+def _section_priority(section):
+    for key in (section.get("category"), section.get("label")):
+        for i, name in enumerate(SECTION_PRIORITY):
+            # Label は CONCLUSION / OBJECTIVES などの表記揺れがあるので語幹で比べる
+            if key and key.startswith(name.rstrip("S")):
+                return i
+    return len(SECTION_PRIORITY)
+
+
+# 文の区切りで budget トークンに収まるところまで切り詰める（1文も収まらなければ空文字）
+def _truncate_sentences(text, budget):
+    kept = []
+    for sentence in _SENTENCE_END.split(text):
+        if llm.estimate_tokens(" ".join(kept + [sentence])) > budget:
+            break
+        kept.append(sentence)
+    return " ".join(kept)
+
+
+# 上限まで文字単位で切り詰める（上限が小さすぎても先頭の1文字は残す）
+def _truncate_chars(text, budget):
+    low, high = 1, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if llm.estimate_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low].rstrip()
+
+
+# 要約に渡す Abstract をトークンの上限に収める（残したセクションは元の順序で並べる）
+def compact_abstract(data, budget=ABSTRACT_TOKEN_BUDGET):
+    abstract = data.get("abstract", "")
+    if budget <= 0 or llm.estimate_tokens(abstract) <= budget:
+        return abstract
+    # セクションを持たない論文情報（ローカル検索インデックスの古い形式など）は全体を1セクションとして扱う
+    sections = data.get("sections") or [{"label": "", "category": "", "text": abstract}]
+    order = sorted(range(len(sections)), key=lambda i: (_section_priority(sections[i]), i))
+    kept = {}
+    remaining = budget
+    for i in order:
+        section = sections[i]
+        heading = llm.estimate_tokens(f"{section['label']}: ") if section["label"] else 0
+        text = section["text"]
+        if llm.estimate_tokens(text) + heading > remaining:
+            text = _truncate_sentences(text, remaining - heading)
+            # 最も優先するセクションが1文も収まらない場合は、見出しを付けずに先頭を切り詰めて渡す
+            if not text and not kept and section["text"].strip():
+                return _truncate_chars(section["text"].strip(), budget)
+        if text:
+            kept[i] = {**section, "text": text}
+            remaining -= llm.estimate_tokens(text) + heading
+        if remaining <= 0:
+            break
+    # どのセクションも残らなかった場合は、Abstract 全体の先頭を切り詰めて渡す
+    if not kept:
+        return _truncate_chars(abstract.strip(), budget)
+    return format_sections([kept[i] for i in sorted(kept)])
+
+
+# Abstractを日本語で要約
+# pmid を指定すると、成功した要約をキャッシュに保存する（max_tokens で打ち切られた要約は保存しない）
+# 同じ論文・モデルの要約が実行中なら、その結果を待って使う
+def summarize_in_japanese(abstract_text, model, pmid=None):
+    try:
+        return singleflight.do("summary", (model, pmid, abstract_text),
+                               lambda: _summarize(abstract_text, model, pmid))
+    except:
+        return SUMMARY_FAILED
+
+
+def _summarize(abstract_text, model, pmid):
+    prompt = f"--- Abstract ---\n{abstract_text}"
+    model = router.choose("summary", model)
+    with metrics.stage("summary"):
+        result = router.complete("summary", model, prompt, SUMMARY_SYSTEM_PROMPT)
+    # スロットリングで他のモデルに切り替わった場合は、実際に使ったモデルの要約として保存する
+    if pmid and result.text and result.stop_reason not in llm.TRUNCATED_STOP_REASONS:
+        get_summary_cache().set(get_summary_cache_key(pmid, result.model), result.text)
+    return result.text
+
+
+# Abstractを日本語で要約（ストリーミング版、生成されたテキストを少しずつ返す）
+# pmid を指定すると、最後まで生成できた要約をキャッシュに保存する（max_tokens で打ち切られた要約は保存しない）
+# 同じ論文・モデルの要約が生成中なら、新たに生成せずそのテキストを受け取る（保存は生成した側だけが行う）
+def summarize_in_japanese_stream(abstract_text, model, pmid=None):
+    prompt = f"--- Abstract ---\n{abstract_text}"
+    model = router.choose("summary", model)
+    info = {}
+    received = []
+    started = time.perf_counter()
+    try:
+        for text in singleflight.stream("summary_stream", (model, pmid, abstract_text),
+                                        lambda: router.stream("summary", model, prompt, SUMMARY_SYSTEM_PROMPT,
+                                                              info=info)):
+            received.append(text)
+            yield text
+    except Exception as e:
+        metrics.inc("stage_errors_total", stage="summary", error=type(e).__name__)
+        if not received:
+            yield SUMMARY_FAILED
+        return
+    finally:
+        metrics.observe_stage("summary", time.perf_counter() - started)
+    summary = "".join(received).strip()
+    # スロットリングで他のモデルに切り替わった場合は、実際に使ったモデルの要約として保存する
+    if pmid and summary and "model" in info and info["stop_reason"] not in llm.TRUNCATED_STOP_REASONS:
+        get_summary_cache().set(get_summary_cache_key(pmid, info["model"]), summary)
+
+
+# 一括要約の応答（JSON）を検証し、PMID ごとの要約に分ける
+# 依頼していない PMID や空の要約は捨てる
+def parse_batch_summaries(text, pmids):
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        return {}
+    try:
+        items = json.loads(text[start:end + 1]).get("summaries", [])
+    except (ValueError, AttributeError):
+        return {}
+    summaries = {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        pmid = str(item.get("pmid", "")).strip()
+        summary = item.get("summary")
+        if pmid in pmids and isinstance(summary, str) and summary.strip():
+            summaries[pmid] = summary.strip()
+    return summaries
+
+
+# 複数のAbstractを1回の呼び出しでまとめて要約し、{pmid: 要約} を返す
+# 入力・出力の予算に収まらない場合や、応答を解釈できない場合は空の dict を返す（呼び出し側で1件ずつ要約する）
+# 同じ論文の組の一括要約が実行中なら、その結果を待って使う
+def summarize_batch_in_japanese(papers, model):
+    prompt = "\n\n".join(f"--- PMID: {data['pmid']} ---\n{compact_abstract(data)}" for data in papers)
+    model = router.choose("batch_summary", model)
+    max_tokens = llm.get_generation_params(model)["max_tokens"]
+    if (llm.estimate_tokens(BATCH_SUMMARY_SYSTEM_PROMPT + prompt) > BATCH_SUMMARY_INPUT_BUDGET
+            or len(papers) * BATCH_SUMMARY_OUTPUT_PER_PAPER > max_tokens):
+        return {}
+    try:
+        with metrics.stage("batch_summary"):
+            result = singleflight.do("batch_summary", (model, prompt), lambda: router.complete(
+                "batch_summary", model, prompt, BATCH_SUMMARY_SYSTEM_PROMPT, units=len(papers)))
+    except Exception:
+        return {}
+    summaries = parse_batch_summaries(result.text, {data["pmid"] for data in papers})
+    get_summary_cache().set_many({
+        get_summary_cache_key(pmid, result.model, batch=True): summary for pmid, summary in summaries.items()
+    })
+    return summaries
+
+
+# 1件分の要約を実行し、結果を (カード番号, テキスト) としてキューに送る
+# 最後に (カード番号, None) を送って完了を知らせる
+def run_summary(index, pmid, abstract_text, model, stream, updates):
+    try:
+        if stream:
+            for text in summarize_in_japanese_stream(abstract_text, model, pmid):
+                updates.put((index, text))
+        else:
+            updates.put((index, summarize_in_japanese(abstract_text, model, pmid)))
+    finally:
+        updates.put((index, None))
+
+
+# ローカルの検索インデックスでヒットした論文を、PubMed の検索結果が届くまでの候補にする
+# 要約はキャッシュ済みのものだけを付ける（LLM は呼ばない）
+def local_hits_preview(hits, model):
+    if not hits:
+        return []
+    summaries = get_cached_summaries([data["pmid"] for data in hits], model)
+    return [{"title": data["title"], "pubdate": data["pubdate"], "url": data["url"],
+             "summary": summaries.get(data["pmid"], "")} for data in hits]
+
+
+# 論文ブロックを PMID の順にジョブに追加し、要約はすべて同時にリクエストする
+# キャッシュ済みの要約はまとめて読み込む。要約を待っているブロックには "pending" を付け、届いたテキストを順に追記する
+def summarize_papers(job, papers, model, batch_mode, stream_mode, executor):
+    cached_summaries = get_cached_summaries([data["pmid"] for data in papers], model)
+    updates = queue.Queue()
+    pending = set()
+    to_summarize = []
+    for data in papers:
+        block = {
+            "type": "paper",
+            "pmid": data["pmid"],
+            "title": data["title"],
+            "authors": data["authors"],
+            "pubdate": data["pubdate"],
+            "url": data["url"],
+            "summary": ""
+        }
+        cached = cached_summaries.get(data["pmid"])
+        if data['abstract'] and cached:
+            block["summary"] = cached
+        elif data['abstract']:
+            block["pending"] = True
+        index = job.add_block(block)
+        if block.get("pending"):
+            pending.add(index)
+            to_summarize.append((index, data))
+
+    # 一括要約モードでは、まず1回の呼び出しでまとめて要約する
+    if batch_mode and len(to_summarize) > 1:
+        job.set_progress("📝 まとめて要約生成中...")
+        batch_summaries = summarize_batch_in_japanese([data for _, data in to_summarize], model)
+        for index, data in list(to_summarize):
+            if data["pmid"] in batch_summaries:
+                job.update_block(index, summary=batch_summaries[data["pmid"]], pending=False)
+                pending.discard(index)
+                to_summarize.remove((index, data))
+        job.set_progress("")
+
+    # 残りは1件ずつ同時にリクエストする
+    for index, data in to_summarize:
+        executor.submit(run_summary, index, data["pmid"], compact_abstract(data), model, stream_mode, updates)
+
+    # 届いた順に各ブロックの要約を更新（ブロックの順序は PMID 順のまま）
+    while pending:
+        index, text = updates.get()
+        if text is None:
+            summary = job.get_block(index)["summary"].strip() or SUMMARY_FAILED
+            job.update_block(index, summary=summary, pending=False)
+            pending.discard(index)
+        else:
+            job.append_text(index, "summary", text)
+
+
+# 1つの質問に対する処理（クエリ生成 → 検索 → 論文取得 → 要約）を jobs.py のジョブとして実行する
+# aws2.py の画面と負荷試験（bench）の両方から使う。途中経過はジョブに書き込み、画面の表示は呼び出し側が行う
+# 戻り値は「さらに論文を表示」に使う検索の状態（論文が無い場合は None）
+def answer_job(job, question, model, batch_mode, stream_mode, summary_executor, search_executor, per_page=3):
+    started = time.perf_counter()
+    try:
+        return _answer_job(job, question, model, batch_mode, stream_mode, summary_executor, search_executor, per_page)
+    finally:
+        metrics.observe_stage("total", time.perf_counter() - started)
+
+
+def _answer_job(job, question, model, batch_mode, stream_mode, summary_executor, search_executor, per_page):
+    job.set_progress("🔍 PubMed検索クエリを生成中...")
+    try:
+        query = ask_gpt_for_pubmed_query(question, model).strip()
+    except Exception as e:
+        job.add_block({"type": "error", "message": f"❌ クエリ生成中にエラーが発生しました: {str(e)}"})
+        return None
+
+    if is_empty_query(query):
+        job.add_block({"type": "error", "message": "⚠️ 適切な医学的な質問を入力してください。"})
+        return None
+    queries = split_queries(query)
+    query_block = job.add_block({"type": "query", "query": queries[0], "candidates": queries})
+
+    # 検索（候補の取得と並べ替え）を別スレッドで始め、結果を待つ間にローカルのインデックスでヒットした論文を表示する
+    job.set_progress("📚 論文を検索中...")
+    search_future = search_executor.submit(search_papers, query, per_page)
+    local_hits = next((hits for hits in (local_index.search(q, per_page) for q in queries) if hits), [])
+    job.set_progress("📚 論文を検索中...", local_hits_preview(local_hits, model))
+    search, papers, ranked_rest = search_future.result()
+    job.set_progress("", preview=[])
+    # 表示する検索式は、実際に論文がヒットした候補（「さらに論文を表示」もこの検索式の続き）
+    job.update_block(query_block, query=search["query"])
+
+    if not papers:
+        job.add_block({"type": "error", "message": "❌ 該当する論文が見つかりませんでした。"})
+        return None
+    summarize_papers(job, papers, model, batch_mode, stream_mode, summary_executor)
+    # 並べ替えで後回しにした候補（ranked）を先に表示し、その後は履歴サーバーの retstart 件目から取得する
+    return {**search, "ranked": ranked_rest, "retstart": len(search["pmids"]), "shown": len(papers), "model": model}
+
+
+# 「さらに論文を表示」: 並べ替え済みの候補の続き、それも尽きたら履歴サーバーから次のページを取得して要約する
+# （クエリ生成と esearch はやり直さない。履歴が期限切れの場合だけ esearch をやり直す）
+# 戻り値は更新した検索の状態（渡された search は書き換えない）
+def more_papers_job(job, search, batch_mode, stream_mode, summary_executor, per_page=3):
+    search = dict(search)
+    job.set_progress("📄 続きの論文を取得中...")
+    if search["ranked"]:
+        papers = fetch_pubmed_metadata_batch(search["ranked"][:per_page])
+        search["ranked"] = search["ranked"][per_page:]
+    else:
+        papers = fetch_pubmed_page(search, search["retstart"], per_page)
+        search["retstart"] += per_page
+    job.set_progress("")
+    if papers:
+        summarize_papers(job, papers, search["model"], batch_mode, stream_mode, summary_executor)
+    else:
+        job.add_block({"type": "error", "message": "❌ これ以上の論文はありません。"})
+    search["shown"] += len(papers)
+    return search
+
+
+# 1つの質問に対してパイプライン全体（クエリ生成 → 検索 → 論文取得 → 要約）を実行する
+# 画面を使わない処理（batch.py など）向けに、結果を JSON にできる dict で返す
+def answer_question(question, model, max_results=3, batch_summary=False):
+    with metrics.stage("total"):
+        return _answer_question(question, model, max_results, batch_summary)
+
+
+def _answer_question(question, model, max_results, batch_summary):
+    result = {"question": question, "model": model, "query": "", "papers": [], "error": ""}
+
+    query = ask_gpt_for_pubmed_query(question, model).strip()
+    if is_empty_query(query):
+        result["error"] = "適切な医学的な質問を入力してください。"
+        return result
+
+    search, papers, _ = search_papers(query, max_results)
+    result["query"] = search["query"]
+    if not papers:
+        result["error"] = "該当する論文が見つかりませんでした。"
+        return result
+
+    summaries = get_cached_summaries([data["pmid"] for data in papers], model)
+    missing = [data for data in papers if data["abstract"] and data["pmid"] not in summaries]
+    if batch_summary and len(missing) > 1:
+        summaries.update(summarize_batch_in_japanese(missing, model))
+    for data in missing:
+        if data["pmid"] not in summaries:
+            summaries[data["pmid"]] = summarize_in_japanese(compact_abstract(data), model, data["pmid"])
+
+    for data in papers:
+        result["papers"].append({
+            "pmid": data["pmid"],
+            "title": data["title"],
+            "authors": data["authors"],
+            "pubdate": data["pubdate"],
+            "url": data["url"],
+            "summary": summaries.get(data["pmid"], "") if data["abstract"] else "",
+        })
+    return result
@@ -0,0 +1,276 @@
+import os
+import threading
+import xml.etree.ElementTree as ET
+from requests import HTTPError, RequestException
+import http_client
+import local_index
+import metrics
+import mirror
+import singleflight
+from ratelimit import TokenBucket
+from cache import get_pubmed_cache
+from pubmed_xml import parse_pubmed_xml
+
+# NCBI E-utilities のエンドポイント（NCBI_EUTILS_BASE でベンチマーク用のスタブなどに向けられる）
+EUTILS_BASE = os.getenv("NCBI_EUTILS_BASE", "https://eutils.ncbi.nlm.nih.gov/entrez/eutils").rstrip("/")
+ESEARCH_URL = f"{EUTILS_BASE}/esearch.fcgi"
+EFETCH_URL = f"{EUTILS_BASE}/efetch.fcgi"
+
+# 1リクエストでまとめて問い合わせる PMID の上限（URL長の制限を避けるため）
+BATCH_SIZE = 200
+
+# NCBI のリクエスト上限（APIキーなし: 3回/秒、APIキーあり: 10回/秒）
+# NCBI_RATE_LIMIT を指定すると両方をその値にする（ベンチマーク用）
+RATE_WITHOUT_KEY = float(os.getenv("NCBI_RATE_LIMIT", "3"))
+RATE_WITH_KEY = float(os.getenv("NCBI_RATE_LIMIT", "10"))
+
+# 検索と論文情報の取得に使う接続先
+# - "live": E-utilities に問い合わせる
+# - "local": PubMed のローカルミラー（mirror.py で取り込んだもの）を先に引き、見つからない場合だけ E-utilities に問い合わせる
+#   ミラーのヒットが求めた件数に満たなくても、ミラーが検索の期間を網羅していれば（mirror.py の covers）そのまま使う
+#   （ミラーの更新が止まっていて期間の最近の論文が無い場合だけ E-utilities に問い合わせる）
+PUBMED_BACKEND = os.getenv("PUBMED_BACKEND", "live")
+
+# APIキーごとのレート制限（プロセス内の全セッション・全スレッドで共有）
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _get_limiter(api_key):
+    with _limiters_lock:
+        limiter = _limiters.get(api_key)
+        if limiter is None:
+            limiter = TokenBucket(RATE_WITH_KEY if api_key else RATE_WITHOUT_KEY)
+            _limiters[api_key] = limiter
+        return limiter
+
+
+# 共通パラメータ（api_key / tool / email）を付与する。未指定なら環境変数を使う
+def _ncbi_params(params, api_key=None, tool=None, email=None):
+    params = dict(params)
+    api_key = api_key or os.getenv("NCBI_API_KEY")
+    tool = tool or os.getenv("NCBI_TOOL")
+    email = email or os.getenv("NCBI_EMAIL")
+    if api_key:
+        params["api_key"] = api_key
+    if tool:
+        params["tool"] = tool
+    if email:
+        params["email"] = email
+    return params
+
+
+# レート制限をかけて E-utilities を呼び出す（リトライ時も1回ずつ予算を消費する）
+# stream=True なら本文を読み込まずに返す（response.raw から少しずつ読む）
+def _eutils_request(method, url, params, api_key=None, tool=None, email=None, stream=False):
+    params = _ncbi_params(params, api_key, tool, email)
+    limiter = _get_limiter(params.get("api_key"))
+    endpoint = url.rsplit("/", 1)[-1].split(".")[0]  # esearch / esummary / efetch
+    with metrics.timer("ncbi_seconds", endpoint=endpoint):
+        if method == "GET":
+            response = http_client.request("GET", url, endpoint=endpoint, before_attempt=limiter.acquire,
+                                           params=params, stream=stream)
+        else:
+            response = http_client.request("POST", url, endpoint=endpoint, before_attempt=limiter.acquire,
+                                           data=params, stream=stream)
+    response.raise_for_status()
+    return response
+
+
+# 同じ条件の esearch が実行中なら、その結果を待って使う（同じ質問が一斉に送られた場合に1回にする）
+def _esearch(query, max_results, retstart=0, usehistory=False, api_key=None, tool=None, email=None):
+    key = (query, max_results, retstart, usehistory)
+    res = singleflight.do("esearch", key, lambda: _esearch_once(query, max_results, retstart, usehistory,
+                                                                api_key, tool, email))
+    return {**res, "idlist": list(res.get("idlist", []))}
+
+
+def _esearch_once(query, max_results, retstart, usehistory, api_key, tool, email):
+    params = {
+        "db": "pubmed",
+        "term": query,
+        "retmode": "json",
+        "retmax": max_results
+    }
+    if retstart:
+        params["retstart"] = retstart
+    if usehistory:
+        params["usehistory"] = "y"
+    with metrics.stage("esearch"):
+        res = _eutils_request("GET", ESEARCH_URL, params, api_key, tool, email).json()
+    return res.get('esearchresult', {})
+
+
+# ローカルミラー（PUBMED_BACKEND=local で、ミラーが使える場合だけ）
+def _get_mirror():
+    return mirror.get_mirror() if PUBMED_BACKEND == "local" else None
+
+
+# ローカルミラーを検索する（ミラーが使えない場合やヒットしない場合は空のリスト）
+def _search_mirror(query, max_results, offset=0):
+    local = _get_mirror()
+    if local is None:
+        return []
+    pmids = local.search(query, max_results, offset)
+    metrics.record_cache("mirror_search", bool(pmids), not pmids)
+    return pmids
+
+
+# PubMed検索
+def search_pubmed(query, max_results=3, api_key=None, tool=None, email=None):
+    pmids = _search_mirror(query, max_results)
+    # ミラーのヒットをすべて返していて（count 以下）、ミラーが期間を網羅していれば件数が少なくても使う
+    if pmids and (len(pmids) >= max_results
+                  or (_get_mirror().count(query) <= len(pmids) and _get_mirror().covers(query))):
+        return pmids
+    try:
+        live = _esearch(query, max_results, api_key=api_key, tool=tool, email=email).get('idlist', [])
+    except RequestException:
+        # E-utilities に問い合わせられない場合は、足りなくてもミラーのヒットを使う
+        if pmids:
+            return pmids
+        raise
+    return live if len(live) >= len(pmids) else pmids
+
+
+# PubMed検索（結果を E-utilities の履歴サーバーに残す）
+# 続きのページは fetch_pubmed_page に戻り値をそのまま渡して取得する（クエリ生成や esearch をやり直さない）
+# 戻り値: {"query", "pmids", "count"（ヒット総数）, "webenv", "query_key"}
+# ローカルミラーのヒットを使う場合は履歴サーバーを使わず、"backend" を "local" にする（続きのページもミラーから取得する）
+def search_pubmed_history(query, max_results=3, api_key=None, tool=None, email=None):
+    pmids = _search_mirror(query, max_results)
+    local = None
+    if pmids:
+        local = {"query": query, "pmids": pmids, "count": _get_mirror().count(query),
+                 "webenv": "", "query_key": "", "backend": "local"}
+        # ミラーのヒットをすべて返していて（count 以下）、ミラーが期間を網羅していれば件数が少なくても使う
+        if len(pmids) >= max_results or (local["count"] <= len(pmids) and _get_mirror().covers(query)):
+            return local
+    try:
+        res = _esearch(query, max_results, usehistory=True, api_key=api_key, tool=tool, email=email)
+    except RequestException:
+        # E-utilities に問い合わせられない場合は、足りなくてもミラーのヒットを使う
+        if local:
+            return local
+        raise
+    if local and len(res.get("idlist", [])) < len(pmids):
+        return local
+    return {
+        "query": query,
+        "pmids": res.get("idlist", []),
+        "count": int(res.get("count") or 0),
+        "webenv": res.get("webenv", ""),
+        "query_key": res.get("querykey", ""),
+    }
+
+
+# 論文情報の形式のバージョン（形式を変えたら上げる。古い形式のキャッシュは使わない）
+RECORD_VERSION = "2"
+
+
+def _cache_key(pmid):
+    return f"{RECORD_VERSION}|{pmid}"
+
+
+# efetch (retmode=xml) で論文情報を取得し、PMID をキーにした dict で返す（応答の順序を保つ）
+# 同じ条件の efetch が実行中なら、その結果を待って使う
+def _efetch_records(params, api_key=None, tool=None, email=None):
+    records = singleflight.do("efetch", tuple(sorted(params.items())),
+                              lambda: _efetch_records_once(params, api_key, tool, email))
+    # 呼び出し側で書き換えても他の呼び出しに影響しないよう、論文ごとに複製して返す
+    return {pmid: dict(record) for pmid, record in records.items()}
+
+
+def _efetch_records_once(params, api_key, tool, email):
+    response = _eutils_request("POST", EFETCH_URL, {"db": "pubmed", "retmode": "xml", **params},
+                               api_key, tool, email, stream=True)
+    try:
+        response.raw.decode_content = True
+        return {record["pmid"]: record for record in parse_pubmed_xml(response.raw)}
+    finally:
+        response.close()
+
+
+# NCBI から論文情報とAbstractをまとめて取得し、PMID をキーにした dict で返す
+# 件数が多い場合は batch_size ごとに分割して問い合わせる（efetch を1回ずつ）
+def _fetch_records(pmids, batch_size, api_key=None, tool=None, email=None):
+    records = {}
+    for i in range(0, len(pmids), batch_size):
+        chunk = pmids[i:i + batch_size]
+        records.update(_efetch_records({"id": ",".join(chunk)}, api_key, tool, email))
+    return records
+
+
+# 複数の PMID の論文情報とAbstractをまとめて取得
+# ローカルキャッシュにあるものはそこから読み、無いものだけを NCBI に問い合わせる
+# 戻り値は pmids と同じ順序のリスト（取得できなかった PMID は除く）
+def fetch_pubmed_metadata_batch(pmids, batch_size=BATCH_SIZE, api_key=None, tool=None, email=None, use_cache=True):
+    pmids = [str(p) for p in pmids]
+    # ローカルミラーにあるものはそこから読む（キャッシュやローカル検索インデックスには入れない）
+    local = _get_mirror()
+    records = local.get_many(pmids) if local else {}
+    if local:
+        metrics.record_cache("mirror", len(records), len(set(pmids)) - len(records))
+
+    cache = get_pubmed_cache() if use_cache else None
+    cached = cache.get_many([_cache_key(p) for p in pmids if p not in records]) if cache else {}
+    records.update((record["pmid"], record) for record in cached.values())
+
+    missing = [p for p in dict.fromkeys(pmids) if p not in records]
+    if cache:
+        metrics.record_cache("pubmed", len(cached), len(missing))
+        # キャッシュにあってローカル検索インデックスに無い論文（インデックス導入前に取得したもの）も登録する
+        local_index.add_records(cached.values(), replace=False)
+    if missing:
+        with metrics.stage("fetch"):
+            fetched = _fetch_records(missing, batch_size, api_key, tool, email)
+        if cache:
+            cache.set_many({_cache_key(p): record for p, record in fetched.items()})
+        local_index.add_records(fetched.values())
+        records.update(fetched)
+
+    return [records[p] for p in pmids if p in records]
+
+
+# search_pubmed_history の検索結果の retstart 件目から retmax 件の論文情報とAbstractを取得する
+# 履歴サーバーを使った efetch 1回で取得する
+# 履歴の有効期限が切れていた場合は esearch だけをやり直し、search の webenv / query_key を更新する
+# ローカルミラーで検索した結果（"backend" が "local"）の場合は、ミラーから続きを検索する
+def fetch_pubmed_page(search, retstart, retmax, api_key=None, tool=None, email=None, use_cache=True):
+    if retstart >= search["count"]:
+        return []
+    if search.get("backend") == "local":
+        pmids = _search_mirror(search["query"], retmax, retstart)
+        if pmids:
+            return fetch_pubmed_metadata_batch(pmids, api_key=api_key, tool=tool, email=email, use_cache=use_cache)
+    records = {}
+    if search.get("webenv"):
+        params = {"WebEnv": search["webenv"], "query_key": search["query_key"], "retstart": retstart, "retmax": retmax}
+        try:
+            with metrics.stage("fetch"):
+                records = _efetch_records(params, api_key, tool, email)
+        except (HTTPError, ET.ParseError):
+            records = {}
+    if not records:
+        res = _esearch(search["query"], retmax, retstart, usehistory=True, api_key=api_key, tool=tool, email=email)
+        search.update(webenv=res.get("webenv", ""), query_key=res.get("querykey", ""), count=int(res.get("count") or 0))
+        return fetch_pubmed_metadata_batch(res.get("idlist", []), api_key=api_key, tool=tool, email=email,
+                                           use_cache=use_cache)
+
+    if use_cache:
+        get_pubmed_cache().set_many({_cache_key(p): record for p, record in records.items()})
+    local_index.add_records(records.values())
+    return list(records.values())
+
+
+# 古い形式の論文情報をキャッシュから削除する
+def purge_old_records():
+    get_pubmed_cache().retain_prefixes([f"{RECORD_VERSION}|"])
+
+
+# PubMedの論文情報とAbstractを取得（1件版）
+def fetch_pubmed_metadata(pmid, api_key=None, tool=None, email=None, use_cache=True):
+    records = fetch_pubmed_metadata_batch([pmid], api_key=api_key, tool=tool, email=email, use_cache=use_cache)
+    if not records:
+        raise KeyError(pmid)
+    return records[0]
@@ -0,0 +1,83 @@
+import xml.etree.ElementTree as ET
+
+# PubMed の XML（PubmedArticleSet）を論文情報の dict に変換する
+# E-utilities の efetch（pubmed.py）と、baseline ファイルのローカルミラー（mirror.py）の両方から使う
+
+
+# 要素内のテキスト（<i> や <sup> などの入れ子も含めて連結する）
+def _text(elem):
+    return "".join(elem.itertext()).strip() if elem is not None else ""
+
+
+def _pubdate(article):
+    date = article.find("Journal/JournalIssue/PubDate")
+    if date is None:
+        return ""
+    return date.findtext("MedlineDate") or " ".join(
+        x for x in (date.findtext("Year"), date.findtext("Month"), date.findtext("Day")) if x)
+
+
+def _authors(article, limit=3):
+    names = []
+    for author in article.iterfind("AuthorList/Author"):
+        name = author.findtext("CollectiveName") or " ".join(
+            x for x in (author.findtext("LastName"), author.findtext("Initials")) if x)
+        if name:
+            names.append(name)
+        if len(names) >= limit:
+            break
+    return ", ".join(names)
+
+
+# Abstract のセクション（BACKGROUND / METHODS / RESULTS / CONCLUSIONS など）
+# category は NLM が付けた分類（Label の表記揺れによらず使える）。見出しの無い Abstract は label が空の1セクションになる
+def _sections(article):
+    sections = []
+    for node in article.iterfind("Abstract/AbstractText"):
+        text = _text(node)
+        if text:
+            sections.append({"label": (node.get("Label") or "").upper(),
+                             "category": (node.get("NlmCategory") or "").upper(),
+                             "text": text})
+    return sections
+
+
+# セクションを「見出し: 本文」の形で連結する
+def format_sections(sections):
+    return "\n".join(f"{s['label']}: {s['text']}" if s["label"] else s["text"] for s in sections)
+
+
+# PubmedArticle 要素を論文情報の dict に変換する
+# 表示用の項目（title / authors / pubdate / url / abstract）に加えて、
+# Abstract のセクション・雑誌名・MeSH 用語・出版タイプを持つ（引用情報や所属機関は持たない）
+def _parse_article(elem):
+    citation = elem.find("MedlineCitation")
+    pmid = citation.findtext("PMID")
+    article = citation.find("Article")
+    sections = _sections(article)
+    return {
+        "pmid": pmid,
+        "title": _text(article.find("ArticleTitle")),
+        "authors": _authors(article),
+        "pubdate": _pubdate(article),
+        "journal": article.findtext("Journal/ISOAbbreviation") or article.findtext("Journal/Title") or "",
+        "url": f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/",
+        "abstract": format_sections(sections),
+        "sections": sections,
+        "mesh_terms": [_text(d) for d in citation.iterfind("MeshHeadingList/MeshHeading/DescriptorName")],
+        "publication_types": [_text(t) for t in article.iterfind("PublicationTypeList/PublicationType")],
+    }
+
+
+# PubMed の XML（efetch (retmode=xml) の応答や baseline / update ファイル）を1論文ずつ読みながら論文情報に変換する
+# 複数論文の XML でも全体を木として持たず、読み終えた論文の要素は順に捨てる
+# deleted にリストを渡すと、update ファイルの DeleteCitation で削除された PMID をそこに追加する
+def parse_pubmed_xml(source, deleted=None):
+    for _, elem in ET.iterparse(source, events=("end",)):
+        if elem.tag == "PubmedArticle":
+            yield _parse_article(elem)
+            elem.clear()
+        elif elem.tag == "DeleteCitation":
+            if deleted is not None:
+                deleted.extend(_text(pmid) for pmid in elem.iterfind("PMID"))
+            elem.clear()
@@ -0,0 +1,170 @@
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# 類似質問キャッシュの設定（.env または環境変数から）
+QUERY_CACHE_THRESHOLD = float(os.getenv("QUERY_CACHE_THRESHOLD", "0.85"))
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "10000"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", str(24 * 3600)))  # 秒（既定は1日）
+QUERY_CACHE_NGRAM = int(os.getenv("QUERY_CACHE_NGRAM", "2"))
+# 類似度のうち内容語（漢字・カタカナ・英数字）の一致を重視する割合
+CONTENT_WEIGHT = 0.7
+
+# 記号・句読点・空白
+_IGNORED = re.compile(r"[\s\W_]+", re.UNICODE)
+# ひらがな（助詞や語尾の揺れとして扱う）
+_HIRAGANA = re.compile(r"[\u3041-\u309f]+")
+
+
+# 質問文の正規化（全角/半角の統一、小文字化、記号・空白の除去）
+def normalize_question(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _IGNORED.sub("", text)
+
+
+# 内容語（漢字・カタカナ・英数字）だけを残した文字列
+# 「高血圧」と「低血圧」のような1文字違いを、「ですか」「でしょうか」のような語尾の揺れより重く扱うために使う
+def content_chars(normalized):
+    return _HIRAGANA.sub("", normalized)
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    common = len(a & b)
+    return common / (len(a) + len(b) - common)
+
+
+# 文字 n-gram の集合（短い文は文全体を1つの要素にする）
+def char_ngrams(text, n=QUERY_CACHE_NGRAM):
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+# PubMed 検索クエリ生成の結果を、質問文の類似度で引けるようにしたキャッシュ
+# - 正規化後の完全一致は即ヒット
+# - それ以外は文字 n-gram の転置インデックスで候補を絞り、内容語と質問文全体の
+#   Jaccard 係数の加重平均が threshold 以上ならヒット
+# - namespace（モデル名など）ごとに別扱いにする
+# - ヒット/ミスの件数と、最も近かった候補の類似度の分布を記録する（しきい値の調整用）
+class QueryCache:
+    def __init__(self, threshold=QUERY_CACHE_THRESHOLD, max_entries=QUERY_CACHE_MAX_ENTRIES,
+                 ttl=QUERY_CACHE_TTL, ngram=QUERY_CACHE_NGRAM):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.ngram = ngram
+        self._entries = OrderedDict()  # (namespace, normalized) -> (query, grams, content_grams, created_at)
+        self._index = {}  # (namespace, gram) -> set of (namespace, normalized)
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0}
+        self._scores = [0] * 21  # 最も近い候補の類似度を 0.05 刻みで集計
+
+    def get(self, question, namespace=""):
+        key = (namespace, normalize_question(question))
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["exact_hits"] += 1
+                self._scores[-1] += 1
+                return entry[0]
+
+            best_key, best_score = self._most_similar(key)
+            self._scores[int(best_score * 20)] += 1
+            if best_key is not None and best_score >= self.threshold:
+                self._entries.move_to_end(best_key)
+                self._stats["similar_hits"] += 1
+                return self._entries[best_key][0]
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, question, query, namespace=""):
+        key = (namespace, normalize_question(question))
+        if not key[1]:
+            return
+        grams = char_ngrams(key[1], self.ngram)
+        content = char_ngrams(content_chars(key[1]), self.ngram)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (query, grams, content, time.time())
+            for gram in grams:
+                self._index.setdefault((namespace, gram), set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+
+    # ヒット率と類似度分布を返す
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["score_histogram"] = {f"{i * 0.05:.2f}": c for i, c in enumerate(self._scores) if c}
+            stats["entries"] = len(self._entries)
+        lookups = stats["exact_hits"] + stats["similar_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["exact_hits"] + stats["similar_hits"]) / lookups if lookups else 0.0
+        stats["threshold"] = self.threshold
+        return stats
+
+    # 以下はロック取得済みで呼び出すこと
+    def _live_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl > 0 and time.time() - entry[3] > self.ttl:
+            self._remove(key)
+            return None
+        return entry
+
+    def _most_similar(self, key):
+        namespace, normalized = key
+        grams = char_ngrams(normalized, self.ngram)
+        if not grams:
+            return None, 0.0
+        content = char_ngrams(content_chars(normalized), self.ngram)
+        # 共通する n-gram の数を数えて Jaccard 係数を求める
+        overlap = {}
+        for gram in grams:
+            for candidate in self._index.get((namespace, gram), ()):
+                overlap[candidate] = overlap.get(candidate, 0) + 1
+        best_key, best_score = None, 0.0
+        for candidate, common in overlap.items():
+            entry = self._live_entry(candidate)
+            if entry is None:
+                continue
+            text_score = common / (len(grams) + len(entry[1]) - common)
+            score = CONTENT_WEIGHT * _jaccard(content, entry[2]) + (1 - CONTENT_WEIGHT) * text_score
+            if score > best_score:
+                best_key, best_score = candidate, score
+        return best_key, best_score
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for gram in entry[1]:
+            keys = self._index.get((key[0], gram))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[(key[0], gram)]
+
+
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+
+# プロセス内で共有するクエリキャッシュを返す
+def get_query_cache():
+    global _query_cache
+    with _query_cache_lock:
+        if _query_cache is None:
+            _query_cache = QueryCache()
+        return _query_cache
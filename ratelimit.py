@@ -0,0 +1,84 @@
+import threading
+import time
+
+
+# プロセス全体で共有するトークンバケット
+# rate: 1秒あたりに補充されるトークン数、capacity: 溜めておける上限（バースト量）
+# 予約方式なので、待ちが発生した場合も到着順に払い出される
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # トークンを取得する。予算が残っていれば待たずに戻る
+    def acquire(self, tokens=1):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+# プロセス全体で共有する同時実行数の上限（AIMD で自動調整する）
+# - 成功するたびに上限を少しずつ上げ（上限の数だけ成功するとおよそ 1 増える）、
+#   スロットリングされたら上限を decrease 倍に下げる
+# - 同じ混雑で続けて下げすぎないよう、下げるのは cooldown 秒に1回まで
+# - スロットリングが failover_after 回続き、最後のスロットリングから hold 秒以内の間は「混雑中」とみなす
+class AdaptiveLimiter:
+    def __init__(self, initial=8, minimum=1, maximum=32, decrease=0.5, cooldown=1.0, failover_after=2, hold=30.0):
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        self.limit = min(self.maximum, max(self.minimum, float(initial)))
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.failover_after = failover_after
+        self.hold = hold
+        self.in_flight = 0
+        self.throttles = 0  # 連続したスロットリングの回数
+        self._last_decrease = 0.0
+        self._last_throttle = 0.0
+        self._cond = threading.Condition()
+
+    # 実行枠を取得する。timeout 秒以内に空かなければ False を返す
+    def acquire(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                return False
+            self.in_flight += 1
+            return True
+
+    # 実行枠を返し、結果に応じて上限を調整する
+    # throttled: スロットリングされたかどうか、succeeded: 呼び出しが成功したかどうか
+    # （スロットリング以外のエラーや途中で読むのをやめた場合は、どちらでもないので上限を変えない）
+    def release(self, throttled=False, succeeded=True):
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttles += 1
+                self._last_throttle = now
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+            elif succeeded:
+                self.throttles = 0
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    # スロットリングが続いている（他の接続先に切り替えたほうがよい）かどうか
+    def is_throttled(self):
+        with self._cond:
+            return (self.throttles >= self.failover_after
+                    and time.monotonic() - self._last_throttle < self.hold)
+
+    # 空いている実行枠の数
+    def headroom(self):
+        with self._cond:
+            return int(self.limit) - self.in_flight
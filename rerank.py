@@ -0,0 +1,89 @@
+import math
+import os
+import re
+import time
+from collections import Counter
+import numpy as np
+
+# 検索結果の候補をローカルで並べ替える（LLM で要約する前の安価な絞り込み）
+# - 生成した検索式の語に対する BM25（タイトル＋Abstract）
+# - 発表年の新しさ
+# を組み合わせたスコアの高い順に並べる
+RERANK_K1 = float(os.getenv("RERANK_K1", "1.2"))
+RERANK_B = float(os.getenv("RERANK_B", "0.75"))
+# タイトルの語を Abstract の語の何倍に数えるか
+RERANK_TITLE_WEIGHT = int(os.getenv("RERANK_TITLE_WEIGHT", "2"))
+# スコアに占める新しさの割合と、新しさが半分になる年数
+RERANK_RECENCY_WEIGHT = float(os.getenv("RERANK_RECENCY_WEIGHT", "0.2"))
+RERANK_RECENCY_HALF_LIFE = float(os.getenv("RERANK_RECENCY_HALF_LIFE", "5"))
+
+# 日付範囲の指定（"2020"[PDat] : "3000"[PDat] など）とフィールドタグ
+_DATE_CLAUSE = re.compile(r'"?[\d/]+"?\[(?:pdat|dp|publication date|edat|crdt)\]', re.IGNORECASE)
+_FIELD_TAG = re.compile(r"\[[^\]]*\]")
+_WORD = re.compile(r"[a-z0-9]+")
+_STOPWORDS = {"and", "or", "not", "the", "of", "in", "for", "with", "a", "an", "to", "on", "by", "vs", "versus"}
+
+
+def tokenize(text):
+    return _WORD.findall(text.lower())
+
+
+# PubMed の検索式から並べ替えに使う語を取り出す（論理演算子・フィールドタグ・日付範囲は除く）
+def query_terms(query):
+    text = _FIELD_TAG.sub(" ", _DATE_CLAUSE.sub(" ", query))
+    return list(dict.fromkeys(t for t in tokenize(text) if t not in _STOPWORDS and not t.isdigit()))
+
+
+def _year(pubdate):
+    match = re.search(r"\d{4}", pubdate or "")
+    return int(match.group()) if match else None
+
+
+# 論文ごとの BM25 スコア（論文数 × 語数の行列でまとめて計算する）
+def bm25_scores(terms, documents, k1=RERANK_K1, b=RERANK_B):
+    if not terms or not documents:
+        return np.zeros(len(documents))
+    index = {term: i for i, term in enumerate(terms)}
+    tf = np.zeros((len(documents), len(terms)))
+    lengths = np.zeros(len(documents))
+    for d, tokens in enumerate(documents):
+        lengths[d] = len(tokens)
+        for term, count in Counter(tokens).items():
+            i = index.get(term)
+            if i is not None:
+                tf[d, i] = count
+    df = (tf > 0).sum(axis=0)
+    idf = np.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+    norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))
+    return ((tf * (k1 + 1)) / (tf + norm[:, None]) * idf).sum(axis=1)
+
+
+# 発表年の新しさ（今年なら 1、RERANK_RECENCY_HALF_LIFE 年前なら 0.5。年が不明なら 0）
+def recency_scores(papers, now_year=None):
+    now_year = now_year or time.localtime().tm_year
+    ages = np.array([
+        max(0, now_year - year) if year else math.inf
+        for year in (_year(p.get("pubdate")) for p in papers)
+    ], dtype=float)
+    return np.power(0.5, ages / RERANK_RECENCY_HALF_LIFE)
+
+
+# 論文（pubmed.py の dict）を検索式との関連度と新しさで並べ替えて返す
+# 各 dict に "rerank_score" を付ける。語が取り出せない場合は元の順序のまま返す
+def rerank(query, papers, recency_weight=RERANK_RECENCY_WEIGHT):
+    terms = query_terms(query)
+    if not terms or not papers:
+        return list(papers)
+    documents = [tokenize(p.get("title", "")) * RERANK_TITLE_WEIGHT + tokenize(p.get("abstract", "")) for p in papers]
+    relevance = bm25_scores(terms, documents)
+    if relevance.max() > 0:
+        relevance = relevance / relevance.max()
+    scores = (1 - recency_weight) * relevance + recency_weight * recency_scores(papers)
+    # 同点のときは PubMed の順序を保つ
+    order = np.argsort(-scores, kind="stable")
+    ranked = []
+    for i in order:
+        paper = dict(papers[i])
+        paper["rerank_score"] = float(scores[i])
+        ranked.append(paper)
+    return ranked
@@ -0,0 +1,186 @@
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+import llm
+import metrics
+
+# タスクごとのモデル自動選択と max_tokens の自動調整
+# - 「自動」モードでは、タスクごとの候補から直近の応答時間が最も短いモデルを選ぶ
+#   （最初の候補が遅くなった場合だけ他の候補に切り替え、ときどき他の候補も試して応答時間を測り直す）
+# - max_tokens は、タスクごとに実測した出力トークン数の分布（p99 × 余裕）から決める
+
+# サイドバーなどで選ぶ「自動」モードのモデル名
+AUTO_MODEL = "自動"
+
+# タスクごとの候補モデル（先頭ほど優先。品質が十分なもののうち速いものを前に置く）
+ROUTES = {
+    "query": ["Claude 3 Sonnet", "Claude Sonnet 4", "Claude 3.7 Sonnet"],
+    "summary": ["Claude Sonnet 4", "Claude 3 Sonnet", "Claude 3.7 Sonnet"],
+    "batch_summary": ["Claude Sonnet 4", "Claude 3.7 Sonnet"],
+}
+
+# 実測値が少ないうちに使う max_tokens（1単位あたり、None ならモデルの既定値）
+DEFAULT_BUDGETS = {
+    "query": 512,
+    "summary": 2048,
+    "batch_summary": None,
+}
+
+# 応答時間・出力トークン数の集計に使う直近の件数
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "50"))
+# 優先する候補が最速の候補よりこの割合以上遅い場合に切り替える
+ROUTER_SLOWDOWN_MARGIN = float(os.getenv("ROUTER_SLOWDOWN_MARGIN", "0.5"))
+# 最速以外の候補を試す確率（応答時間を測り直すため）
+ROUTER_EXPLORE_RATE = float(os.getenv("ROUTER_EXPLORE_RATE", "0.05"))
+# max_tokens を実測値から決めるのに必要な件数と、p99 に掛ける余裕
+ROUTER_BUDGET_MIN_SAMPLES = int(os.getenv("ROUTER_BUDGET_MIN_SAMPLES", "20"))
+ROUTER_BUDGET_HEADROOM = float(os.getenv("ROUTER_BUDGET_HEADROOM", "1.5"))
+ROUTER_BUDGET_FLOOR = int(os.getenv("ROUTER_BUDGET_FLOOR", "256"))
+# max_tokens を自動調整するかどうか（"0" で無効にしてモデルの既定値を使う）
+ROUTER_ADAPTIVE_MAX_TOKENS = os.getenv("ROUTER_ADAPTIVE_MAX_TOKENS", "1") != "0"
+
+
+# モデルが使える設定になっているか（Bedrock は推論プロファイル ARN、Azure は接続先）
+def is_available(model):
+    if llm.MODELS[model]["provider"] == "azure":
+        return bool(os.getenv("api_base"))
+    return bool(llm.get_inference_profile_arn(model))
+
+
+class Router:
+    def __init__(self, routes=None, rng=None):
+        self.routes = routes or ROUTES
+        self._latency = {}  # (タスク, モデル) -> 直近の応答時間
+        self._output = {}  # タスク -> 直近の出力トークン数（1単位あたり）
+        self._random = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def _median_latency(self, task, model):
+        samples = self._latency.get((task, model))
+        if not samples:
+            return None
+        return metrics.percentile(list(samples), 50)
+
+    # タスクに使うモデルを決める（AUTO_MODEL 以外が指定されていればそのまま返す）
+    def choose(self, task, model):
+        if model != AUTO_MODEL:
+            return model
+        candidates = [m for m in self.routes[task] if m in llm.MODELS and is_available(m)]
+        if not candidates:
+            return llm.DEFAULT_MODEL
+        with self._lock:
+            latencies = {m: self._median_latency(task, m) for m in candidates}
+            chosen = candidates[0]
+            measured = [m for m in candidates if latencies[m] is not None]
+            if latencies[chosen] is not None and measured:
+                fastest = min(measured, key=latencies.get)
+                if latencies[chosen] > latencies[fastest] * (1 + ROUTER_SLOWDOWN_MARGIN):
+                    chosen = fastest
+            # ときどき他の候補（未計測のものを優先）を試す
+            others = [m for m in candidates if m != chosen]
+            if others and self._random.random() < ROUTER_EXPLORE_RATE:
+                chosen = self._random.choice([m for m in others if latencies[m] is None] or others)
+        metrics.inc("router_decisions_total", task=task, model=chosen)
+        return chosen
+
+    # タスクの max_tokens（units は一括要約の論文数など、出力が比例して増える単位の数）
+    def max_tokens(self, task, model, units=1):
+        limit = llm.get_generation_params(model)["max_tokens"]
+        if not ROUTER_ADAPTIVE_MAX_TOKENS:
+            return limit
+        with self._lock:
+            samples = list(self._output.get(task, ()))
+        if len(samples) >= ROUTER_BUDGET_MIN_SAMPLES:
+            per_unit = metrics.percentile(samples, 99) * ROUTER_BUDGET_HEADROOM
+        elif DEFAULT_BUDGETS.get(task):
+            per_unit = DEFAULT_BUDGETS[task]
+        else:
+            return limit
+        return min(limit, max(ROUTER_BUDGET_FLOOR, math.ceil(per_unit * units)))
+
+    # 1回の呼び出し結果を記録する
+    # 出力が max_tokens で打ち切られた場合は、次回の予算が増えるよう予算の2倍を出力量として記録する
+    def record(self, task, model, seconds, output_tokens, units=1, truncated=False, budget=0):
+        if truncated and budget:
+            output_tokens = max(output_tokens, budget * 2)
+            metrics.inc("router_truncated_total", task=task, model=model)
+        with self._lock:
+            self._latency.setdefault((task, model), deque(maxlen=ROUTER_WINDOW)).append(seconds)
+            if output_tokens:
+                self._output.setdefault(task, deque(maxlen=ROUTER_WINDOW * 4)).append(output_tokens / max(1, units))
+
+    # 診断パネル向けの集計（タスク × モデルごとの応答時間の中央値と件数、タスクごとの現在の予算）
+    def snapshot(self):
+        with self._lock:
+            latency = {key: (self._median_latency(*key), len(samples)) for key, samples in self._latency.items()}
+            output = {task: list(samples) for task, samples in self._output.items()}
+        rows = []
+        for (task, model), (median, count) in sorted(latency.items()):
+            budget_samples = output.get(task, [])
+            rows.append({
+                "task": task,
+                "model": model,
+                "p50": median,
+                "count": count,
+                "output_p99": metrics.percentile(budget_samples, 99) if budget_samples else None,
+            })
+        return rows
+
+
+_router = Router()
+
+
+# タスクの max_tokens の決め方（要約キャッシュのバージョンに使う）
+# 実際に送る max_tokens は実測値で呼び出しごとに変わるので、その値ではなく決め方の設定を返す
+def budget_policy(task, model):
+    return {
+        "limit": llm.get_generation_params(model)["max_tokens"],
+        "adaptive": ROUTER_ADAPTIVE_MAX_TOKENS,
+        "default": DEFAULT_BUDGETS.get(task),
+        "headroom": ROUTER_BUDGET_HEADROOM,
+        "floor": ROUTER_BUDGET_FLOOR,
+    }
+
+
+# プロセス全体で共有するルーター
+def get_router():
+    return _router
+
+
+# プロセス全体で共有するルーターでモデルを決める
+def choose(task, model):
+    return _router.choose(task, model)
+
+
+# タスクに合わせて max_tokens を決めて呼び出し、応答時間と出力トークン数を記録する
+# model に AUTO_MODEL を渡すとここでモデルを選ぶ（使ったモデルは結果の model に入る）
+def complete(task, model, prompt, system_prompt, units=1):
+    model = _router.choose(task, model)
+    budget = _router.max_tokens(task, model, units)
+    started = time.perf_counter()
+    result = llm.complete(model, prompt, system_prompt, max_tokens=budget)
+    # スロットリングで他のモデルに切り替わった場合は、実際に答えたモデルの応答時間として記録する
+    _router.record(task, result.model, time.perf_counter() - started,
+                   result.output_tokens or llm.estimate_tokens(result.text), units,
+                   truncated=result.stop_reason in llm.TRUNCATED_STOP_REASONS, budget=budget)
+    return result
+
+
+# ストリーミング版（出力トークン数は受け取ったテキストから概算する）
+# キャッシュのキーなどに使うモデルが必要な場合は、先に choose() で決めてから渡す
+# info に dict を渡すと、最後まで受け取った後に llm.stream と同じ項目を入れる
+def stream(task, model, prompt, system_prompt, units=1, info=None):
+    model = _router.choose(task, model)
+    budget = _router.max_tokens(task, model, units)
+    info = {} if info is None else info
+    received = []
+    started = time.perf_counter()
+    for text in llm.stream(model, prompt, system_prompt, info=info, max_tokens=budget):
+        received.append(text)
+        yield text
+    output_tokens = llm.estimate_tokens("".join(received))
+    _router.record(task, info.get("model", model), time.perf_counter() - started, output_tokens, units,
+                   truncated=info.get("stop_reason") in llm.TRUNCATED_STOP_REASONS, budget=budget)
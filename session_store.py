@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from cache import get_blob_cache
+
+# メモリ上に保持する本文の件数（それ以外は SQLite から読む）
+SESSION_STORE_MEMORY_ENTRIES = int(os.getenv("SESSION_STORE_MEMORY_ENTRIES", "2000"))
+
+
+# 会話履歴の本文を共有するストア
+# 同じ内容は同じ参照（ハッシュ）になるので、複数のセッションで同じ要約を見ても1つしか保持しない
+# よく使う本文はメモリ上の LRU に、全体は SQLite（cache.get_blob_cache）に置く
+class SessionStore:
+    def __init__(self, memory_entries=SESSION_STORE_MEMORY_ENTRIES):
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    # 値（JSON にできるもの）を保存して参照を返す
+    def put(self, value):
+        payload = json.dumps(value, ensure_ascii=False, sort_keys=True)
+        ref = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+        with self._lock:
+            known = ref in self._memory
+            self._remember(ref, value)
+        if not known:
+            get_blob_cache().set(ref, value)
+        return ref
+
+    # 複数の参照をまとめて解決する（見つからないものは含まない）
+    def get_many(self, refs):
+        values = {}
+        missing = []
+        with self._lock:
+            for ref in dict.fromkeys(refs):
+                if ref in self._memory:
+                    self._memory.move_to_end(ref)
+                    values[ref] = self._memory[ref]
+                else:
+                    missing.append(ref)
+        if missing:
+            loaded = get_blob_cache().get_many(missing)
+            with self._lock:
+                for ref, value in loaded.items():
+                    self._remember(ref, value)
+            values.update(loaded)
+        return values
+
+    # ロック取得済みで呼び出すこと
+    def _remember(self, ref, value):
+        self._memory[ref] = value
+        self._memory.move_to_end(ref)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_session_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SessionStore()
+        return _store
+
+
+# 論文ブロックの本文をストアに移し、セッションには参照だけを残す
+def compact_blocks(blocks):
+    store = get_session_store()
+    compacted = []
+    for block in blocks:
+        if block["type"] == "paper" and "meta_ref" not in block:
+            meta = {k: block[k] for k in ("title", "authors", "pubdate", "url")}
+            block = {
+                "type": "paper",
+                "pmid": block.get("pmid", ""),
+                "meta_ref": store.put(meta),
+                "summary_ref": store.put(block["summary"]) if block["summary"] else "",
+            }
+        compacted.append(block)
+    return compacted
+
+
+# 参照を解決して、表示用の論文ブロックに戻す
+def expand_blocks(blocks):
+    refs = []
+    for block in blocks:
+        if "meta_ref" in block:
+            refs.append(block["meta_ref"])
+            if block["summary_ref"]:
+                refs.append(block["summary_ref"])
+    values = get_session_store().get_many(refs) if refs else {}
+
+    expanded = []
+    for block in blocks:
+        if "meta_ref" in block:
+            meta = values.get(block["meta_ref"]) or {
+                "title": f"PMID {block['pmid']}",
+                "authors": "",
+                "pubdate": "",
+                "url": f"https://pubmed.ncbi.nlm.nih.gov/{block['pmid']}/",
+            }
+            summary = ""
+            if block["summary_ref"]:
+                summary = values.get(block["summary_ref"], "（要約は保存期間を過ぎたため表示できません）")
+            block = {"type": "paper", "pmid": block["pmid"], **meta, "summary": summary}
+        expanded.append(block)
+    return expanded
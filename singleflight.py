@@ -0,0 +1,139 @@
+import os
+import threading
+import metrics
+
+# 同じ処理の同時実行をまとめる（プロセス内の全セッション・全スレッドで共有）
+# - 同じキーの処理が実行中なら、後から来た呼び出しは新たに実行せず、最初の呼び出しの結果を待って受け取る
+# - 最初の呼び出しが例外で終わった場合は、待っていた呼び出しにも同じ例外を送出する
+# - 終わった処理の結果は保持しない（繰り返し使う結果はキャッシュ側で持つ）
+# 同じ質問が一斉に送られたときに、LLM と NCBI への同じ問い合わせを1回にするためのもの
+
+# 他の呼び出しの結果を待つ時間の上限（秒）。ストリーミングでは次のテキストを待つ時間の上限
+SINGLEFLIGHT_TIMEOUT = float(os.getenv("SINGLEFLIGHT_TIMEOUT", "120"))
+# "0" にすると同時実行をまとめない（呼び出しごとにそのまま実行する）
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "1") != "0"
+
+
+class SingleFlightTimeout(TimeoutError):
+    pass
+
+
+# ストリーミングで、実行していた呼び出しが途中で読むのをやめた（画面の再実行などで閉じられた）
+class StreamAbandoned(RuntimeError):
+    pass
+
+
+class _Call:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.done = False
+        self.result = None
+        self.error = None
+        self.chunks = []  # ストリーミングで受け取ったテキスト
+
+
+class Group:
+    def __init__(self, name, timeout=SINGLEFLIGHT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    # 実行中の同じキーの処理があれば (処理, False)、無ければ新しく登録して (処理, True) を返す
+    def _join(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                metrics.inc("singleflight_total", group=self.name, role="shared")
+                return call, False
+            call = self._calls[key] = _Call()
+        metrics.inc("singleflight_total", group=self.name, role="leader")
+        return call, True
+
+    def _finish(self, key, call, result=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        with call.cond:
+            call.result, call.error, call.done = result, error, True
+            call.cond.notify_all()
+
+    # key の処理として fn() を実行し、その結果を返す（同じキーの実行中の処理があればその結果を待つ）
+    def do(self, key, fn):
+        if not SINGLEFLIGHT_ENABLED:
+            return fn()
+        call, leader = self._join(key)
+        if leader:
+            try:
+                result = fn()
+            except BaseException as e:
+                self._finish(key, call, error=e)
+                raise
+            self._finish(key, call, result)
+            return result
+        with call.cond:
+            if not call.cond.wait_for(lambda: call.done, self.timeout):
+                metrics.inc("singleflight_timeouts_total", group=self.name)
+                raise SingleFlightTimeout(f"{self.name}: {self.timeout} 秒待っても結果が届きませんでした")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    # ストリーミング版。fn() が返すイテレーターのテキストを、同じキーの呼び出し全員に順に渡す
+    # 後から来た呼び出しは、それまでに届いたテキストから受け取る
+    # 最初の呼び出しが途中で読むのをやめた場合、待っている呼び出しには StreamAbandoned を送出する
+    def stream(self, key, fn):
+        if not SINGLEFLIGHT_ENABLED:
+            yield from fn()
+            return
+        call, leader = self._join(key)
+        if leader:
+            try:
+                for text in fn():
+                    with call.cond:
+                        call.chunks.append(text)
+                        call.cond.notify_all()
+                    yield text
+            except GeneratorExit:
+                self._finish(key, call, error=StreamAbandoned(self.name))
+                raise
+            except BaseException as e:
+                self._finish(key, call, error=e)
+                raise
+            self._finish(key, call)
+            return
+        sent = 0
+        while True:
+            with call.cond:
+                if not call.cond.wait_for(lambda: call.done or len(call.chunks) > sent, self.timeout):
+                    metrics.inc("singleflight_timeouts_total", group=self.name)
+                    raise SingleFlightTimeout(f"{self.name}: {self.timeout} 秒待ってもテキストが届きませんでした")
+                chunks = call.chunks[sent:]
+                done = call.done
+            for text in chunks:
+                yield text
+            sent += len(chunks)
+            if done and sent == len(call.chunks):
+                break
+        if call.error is not None:
+            raise call.error
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+# 名前ごとに共有するグループ（名前はメトリクスのラベルにもなる）
+def get_group(name):
+    with _groups_lock:
+        group = _groups.get(name)
+        if group is None:
+            group = _groups[name] = Group(name)
+        return group
+
+
+def do(name, key, fn):
+    return get_group(name).do(key, fn)
+
+
+def stream(name, key, fn):
+    return get_group(name).stream(key, fn)